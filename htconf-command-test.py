@@ -1,12 +1,23 @@
 #!/usr/bin/env python3
 # coding:utf-8
 import os
+import resource
+import statistics
 import subprocess
 import unittest
 import tempfile
 import io
+import contextlib
+import json
+import importlib.util
+import htconf
 
 HTCONF = os.path.join(os.getcwd(), "htconf.py")
+# Budget of the cumulative import time of htconf with bytecode cached
+IMPORT_BUDGET_US = 20000
+# Budget of the CPU time of a run of htconf.py over the start of the interpreter, as a
+# ratio to the start. The single-file htconf.py of v1.0, compiled on every run, takes 1.1
+CLI_BUDGET = 1.0
 SAMPLE = """Dir1 None
 Dir2 \"\\\"a\\\\z\\\"\"
 Dir3 On \"($)+\"
@@ -24,6 +35,24 @@ Dir4 Off \"[*].?\"
 
 
 def run(args, input):
+    # htconf.mainをプロセス内で実行し、inputを標準入力として与えます。
+    instream, outstream, errstream = io.StringIO(input), io.StringIO(), io.StringIO()
+    try:
+        with contextlib.redirect_stderr(errstream):
+            htconf.main(args, instream, outstream)
+    except SystemExit as e:
+        # sys.exitで終了した場合、エラーが発生したことになるため、RuntimeErrorを起こします。
+        if e.code:
+            raise RuntimeError(errstream.getvalue())
+    # 標準出力に書き込まれた内容を返します。
+    return outstream.getvalue()
+
+
+def call(args):
+    return run(args, '')
+
+
+def run_command(args, input):
     # subprocessモジュールを使用して、引数として与えられたコマンドを実行し、標準入力からの入力を受け付けます。
     res = subprocess.run(["python3"] + args,
                          input=input, text=True, capture_output=True)
@@ -34,13 +63,6 @@ def run(args, input):
     return res.stdout
 
 
-def call(args):
-    res = subprocess.run(["python3"] + args, text=True, capture_output=True)
-    if res.returncode != 0:
-        raise RuntimeError(res.stderr)
-    return res.stdout
-
-
 class TestAddDirective(unittest.TestCase):
     def test_add_directive_single_value_without_section(self):
         actual = run([HTCONF, "add", "Dir9", "-v", "AAA"], SAMPLE)
@@ -576,5 +598,588 @@ Dir4 XXX
         self.assertEqual(expect, actual, "Result should match expected output")
 
 
+class TestMatchMode(unittest.TestCase):
+    def test_match_exact_token(self):
+        actual = run([HTCONF, "set", "Dir4", "-v", "X", "-w", "Of"],
+                     "Dir4 Off\nDir44 Off\n")
+        expect = "Dir4 Off\nDir44 Off\n"
+        self.assertEqual(expect, actual, "Result should match expected output")
+
+    def test_match_escaped_value(self):
+        actual = run([HTCONF, "disable", "Dir2", "-w", "\"a\\z\""], SAMPLE)
+        expect = SAMPLE.replace("Dir2 \"\\\"", "#Dir2 \"\\\"")
+        self.assertEqual(expect, actual, "Result should match expected output")
+
+    def test_match_quoted_logformat(self):
+        conf = """    LogFormat "%h %l %u %t \\"%r\\" %>s %b \\"%{Referer}i\\"" combined
+    LogFormat "%h %l %u %t \\"%r\\" %>s %b" common
+"""
+        actual = run([HTCONF, "disable", "LogFormat",
+                      "-w", "%h %l %u %t \"%r\" %>s %b", "-w", "common"], conf)
+        expect = conf.replace("    LogFormat \"%h %l %u %t \\\"%r\\\" %>s %b\" common",
+                              "    #LogFormat \"%h %l %u %t \\\"%r\\\" %>s %b\" common")
+        self.assertNotEqual(conf, expect)
+        self.assertEqual(expect, actual, "Result should match expected output")
+
+    def test_match_prefix(self):
+        actual = run([HTCONF, "set", "Dir1", "-v", "X", "-w", "No", "--match=prefix"],
+                     "Dir1 None\nDir1 Off\n")
+        expect = "Dir1 X\nDir1 Off\n"
+        self.assertEqual(expect, actual, "Result should match expected output")
+
+    def test_match_glob(self):
+        actual = run([HTCONF, "set", "Dir4", "-v", "X", "-w", "O*", "-w", "[[]*",
+                      "--match=glob"], SAMPLE)
+        expect = SAMPLE.replace("Dir4 Off \"[*].?\"", "Dir4 X")
+        self.assertEqual(expect, actual, "Result should match expected output")
+
+    def test_match_glob_section(self):
+        actual = run([HTCONF, "disable", "Dir4", "-s", "Sec2:/var/*", "--match=glob"],
+                     SAMPLE)
+        expect = SAMPLE.replace("        Dir4", "        #Dir4")
+        self.assertEqual(expect, actual, "Result should match expected output")
+
+    def test_match_regex(self):
+        actual = run([HTCONF, "disable", "Dir4", "-w", "O(n|ff)", "-w", "\\(.*",
+                      "--match=regex"], SAMPLE)
+        expect = SAMPLE.replace("    Dir4 On", "    #Dir4 On") \
+            .replace("    Dir4 Off \"($)+", "    #Dir4 Off \"($)+")
+        self.assertEqual(expect, actual, "Result should match expected output")
+
+    def test_match_unknown_mode(self):
+        with self.assertRaises(RuntimeError):
+            run([HTCONF, "set", "Dir4", "-v", "X", "--match=fuzzy"], SAMPLE)
+
+
+class TestIgnoreCase(unittest.TestCase):
+    CONF = """servertokens OS
+<directory />
+    ALLOWOVERRIDE none
+</DIRECTORY>
+#traceenable On
+"""
+
+    def test_ignore_case_keeps_original_name(self):
+        actual = run([
+            HTCONF,
+            "-e", "set ServerTokens -v Prod -i",
+            "-e", "set AllowOverride -v All -s Directory:/ -i",
+            "-e", "enable TraceEnable -v Off -i",
+            "-e", "set '<Directory>' -v /var/www -w / -i"
+        ], self.CONF)
+        expect = """servertokens Prod
+<directory /var/www>
+    ALLOWOVERRIDE All
+</DIRECTORY>
+traceenable Off
+"""
+        self.assertEqual(expect, actual, "Result should match expected output")
+
+    def test_ignore_case_add_with_section(self):
+        actual = run([HTCONF, "add", "Require", "-v", "all", "-v", "denied",
+                      "-s", "Directory:/", "-i"], self.CONF)
+        expect = self.CONF.replace("</DIRECTORY>", "    Require all denied\n</DIRECTORY>")
+        self.assertEqual(expect, actual, "Result should match expected output")
+
+    def test_case_sensitive_without_option(self):
+        actual = run([HTCONF, "set", "ServerTokens", "-v", "Prod"], self.CONF)
+        self.assertEqual(self.CONF, actual, "Result should match expected output")
+
+
+class TestBatch(unittest.TestCase):
+    def test_batch_text_jobs(self):
+        jobs = [
+            {"id": 1, "text": SAMPLE, "expressions": ["set Dir1 -v On"]},
+            {"id": 2, "text": SAMPLE, "expressions": ["set Dir9 -v On"]},
+            {"id": 3, "text": SAMPLE, "expressions": ["remove Dir1"]},
+        ]
+        for workers in ("1", "2"):
+            actual = run([HTCONF, "batch", "-j", workers],
+                         "".join(json.dumps(job) + "\n" for job in jobs))
+            results = sorted((json.loads(line) for line in actual.splitlines()),
+                             key=lambda result: result["id"])
+            self.assertEqual(["ok", "ok", "error"], [result["status"] for result in results])
+            self.assertEqual([True, False], [result["changed"] for result in results[:2]])
+            self.assertEqual(SAMPLE.replace("Dir1 None", "Dir1 On"), results[0]["output"])
+            self.assertEqual(SAMPLE, results[1]["output"])
+
+    def test_batch_file_job(self):
+        actual_file = os.path.join(tempfile.gettempdir(), "test_batch_file_job.conf")
+        with open(actual_file, 'w') as f:
+            f.write(SAMPLE)
+        job = {"id": "a", "file": actual_file,
+               "expressions": ["add Dir4 -v XXX", "set Dir2 -v On -w None"]}
+        actual = run([HTCONF, "batch", "-j", "1"], json.dumps(job) + "\n")
+        result = json.loads(actual)
+        self.assertEqual({"id": "a", "status": "ok", "changed": True},
+                         {key: result[key] for key in ("id", "status", "changed")})
+        with open(actual_file, 'r') as f:
+            actual = f.read()
+        expect = SAMPLE.replace("    Dir2 None", "    Dir2 On") + "Dir4 XXX\n"
+        self.assertEqual(expect, actual, "Result should match expected output")
+
+    def test_batch_invalid_job(self):
+        actual = run([HTCONF, "batch", "-j", "1"], "xx\n")
+        self.assertEqual("error", json.loads(actual)["status"])
+
+    def test_batch_invalid_job_fields(self):
+        jobs = [
+            {"id": 1, "file": 1, "expressions": ["set Dir1 -v On"]},
+            {"id": 2, "file": True, "expressions": ["set Dir1 -v On"]},
+            {"id": 3, "text": SAMPLE, "expressions": [5]},
+            {"id": 4, "text": SAMPLE, "expressions": "set Dir1 -v On"},
+            {"id": 5, "text": None, "expressions": ["set Dir1 -v On"]},
+            {"id": 6, "text": SAMPLE, "expressions": ["set Dir1 -v On"]},
+        ]
+        for workers in ("1", "2"):
+            actual = run([HTCONF, "batch", "-j", workers],
+                         "".join(json.dumps(job) + "\n" for job in jobs))
+            results = sorted((json.loads(line) for line in actual.splitlines()),
+                             key=lambda result: result["id"])
+            self.assertEqual(["error"] * 5 + ["ok"], [result["status"] for result in results])
+            self.assertEqual(["file", "file", "expressions", "expressions", "text"],
+                             [result["error"].split("(")[1].split()[0] for result in results[:5]])
+
+    def test_batch_invalid_jobs(self):
+        with self.assertRaises(RuntimeError) as cm:
+            run([HTCONF, "batch", "-j", "x"], "")
+        self.assertIn("Invalid Number (-j x)", str(cm.exception))
+
+
+class TestDump(unittest.TestCase):
+    def test_dump_json(self):
+        actual = [json.loads(line) for line in run([HTCONF, "dump"], SAMPLE).splitlines()]
+        self.assertEqual(12, len(actual))
+        self.assertEqual({"type": "directive", "name": "Dir2", "args": ["\"a\\z\""],
+                          "section": [], "file": None, "line": 2}, actual[1])
+        self.assertEqual({"type": "section", "name": "Sec2", "args": ["/var/www"],
+                          "section": [["Sec1", "/"]], "file": None, "line": 10}, actual[9])
+        self.assertEqual({"type": "directive", "name": "Dir4", "args": ["Off", "[*].?"],
+                          "section": [["Sec1", "/"], ["Sec2", "/var/www"]],
+                          "file": None, "line": 11}, actual[10])
+        self.assertEqual([[None, 4], [None, 8], [None, 9], [None, 11]],
+                         actual[-1]["index"]["Dir4"])
+        self.assertEqual([[None, 10]], actual[-1]["index"]["<Sec2"])
+
+    def test_dump_files(self):
+        actual_file = os.path.join(tempfile.gettempdir(), "test_dump_files.conf")
+        with open(actual_file, 'w') as f:
+            f.write(SAMPLE)
+        actual = run([HTCONF, "dump", "-f", actual_file, "-f", actual_file], "")
+        index = json.loads(actual.splitlines()[-1])["index"]
+        self.assertEqual([[actual_file, 2], [actual_file, 6], [actual_file, 7]],
+                         index["Dir2"][:3])
+        self.assertEqual(6, len(index["Dir2"]))
+
+    def test_dump_unknown_format(self):
+        with self.assertRaises(RuntimeError) as cm:
+            run([HTCONF, "dump", "--format", "xml"], SAMPLE)
+        self.assertIn("Unknown Format (xml)", str(cm.exception))
+
+    def test_dump_msgpack_missing(self):
+        # -S hides the packages installed in site-packages
+        res = subprocess.run(["python3", "-S", HTCONF, "dump", "--format", "msgpack"],
+                             input="", text=True, capture_output=True)
+        self.assertEqual((1, "Missing Module (msgpack is required for --format msgpack)\n"),
+                         (res.returncode, res.stderr))
+
+    @unittest.skipUnless(importlib.util.find_spec("msgpack"), "msgpack is not installed")
+    def test_dump_msgpack(self):
+        import msgpack
+        res = subprocess.run(["python3", HTCONF, "dump", "--format", "msgpack"],
+                             input=SAMPLE.encode(), capture_output=True, check=True)
+        expect = [json.loads(line) for line in run([HTCONF, "dump"], SAMPLE).splitlines()]
+        self.assertEqual(expect, list(msgpack.Unpacker(io.BytesIO(res.stdout))))
+
+
+@unittest.skipUnless(importlib.util.find_spec("numpy"), "numpy is not installed")
+class TestDrift(unittest.TestCase):
+    BASELINE = """ServerTokens Prod
+<Directory />
+    AllowOverride None
+</Directory>
+"""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.files = []
+        for i in range(5):
+            self.files.append(os.path.join(self.tmp_dir.name, f"host{i}.conf"))
+            with open(self.files[-1], 'w') as f:
+                f.write(self.BASELINE)
+        with open(self.files[-1], 'w') as f:
+            f.write(self.BASELINE.replace("None", "All") + "TraceEnable On\nServerSignature On\n")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def drift(self, args, input=""):
+        records = [json.loads(line) for line in run([HTCONF, "drift"] + args, input).splitlines()]
+        return {kind: [record for record in records if record["type"] == kind]
+                for kind in ("setting", "host", "cluster", "error")}
+
+    def test_drift_report(self):
+        actual = self.drift(["-j", "1"] + self.files)
+        settings = {(setting["name"], tuple(setting["args"])): setting
+                    for setting in actual["setting"]}
+        self.assertEqual(5, settings[("<Directory", ("/",))]["hosts"])
+        self.assertEqual([["Directory", "/"]], settings[("AllowOverride", ("None",))]["section"])
+        self.assertEqual(0.8, settings[("AllowOverride", ("None",))]["frequency"])
+        self.assertFalse(settings[("TraceEnable", ("On",))]["baseline"])
+        self.assertEqual([0, 0, 0, 0, 4], [host["drift"] for host in actual["host"]])
+        self.assertEqual([False] * 4 + [True], [host["outlier"] for host in actual["host"]])
+        self.assertEqual([settings[("AllowOverride", ("None",))]["id"]],
+                         actual["host"][-1]["missing"])
+        self.assertEqual([{"type": "cluster", "cluster": 0, "hosts": 4, "files": self.files[:4]},
+                          {"type": "cluster", "cluster": 1, "hosts": 1, "files": self.files[4:]}],
+                         actual["cluster"])
+
+    def test_drift_files_from_stdin_on_pool(self):
+        missing_file = os.path.join(self.tmp_dir.name, "missing.conf")
+        actual = self.drift(["-j", "2"], "\n".join(self.files + [missing_file]) + "\n")
+        self.assertEqual(self.files, [host["file"] for host in actual["host"]])
+        self.assertEqual([missing_file], [error["file"] for error in actual["error"]])
+
+    def test_drift_threshold(self):
+        actual = self.drift(["-j", "1", "-t", "1"] + self.files)
+        self.assertEqual([1, 1, 1, 1, 3], [host["drift"] for host in actual["host"]])
+
+    def test_drift_invalid_threshold(self):
+        with self.assertRaises(RuntimeError) as cm:
+            self.drift(["-t", "x"] + self.files)
+        self.assertIn("Invalid Number (-t x)", str(cm.exception))
+
+
+class TestCheck(unittest.TestCase):
+    POLICY = """# Hardening
+present Dir1 -v None
+present Dir4 -v Off -v "[*].?" -w Off
+absent Dir2 -w None -s Sec1:/
+present '<Sec2>' -w /var --match=prefix
+present dir3 -i
+"""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.policy_file = os.path.join(self.tmp_dir.name, "test.policy")
+        with open(self.policy_file, 'w') as f:
+            f.write(self.POLICY)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def check(self, args, input=""):
+        outstream = io.StringIO()
+        with contextlib.redirect_stderr(io.StringIO()):
+            status = htconf.main([HTCONF, "check", "-p", self.policy_file] + args,
+                                 io.StringIO(input), outstream)
+        return status, [json.loads(line) for line in outstream.getvalue().splitlines()]
+
+    def test_check_pipe(self):
+        status, actual = self.check([], SAMPLE)
+        self.assertEqual(2, status)
+        self.assertEqual([("pass", [1]), ("fail", [9]), ("fail", [6]),
+                          ("pass", [10]), ("pass", [3])],
+                         [(result["status"], result["lines"]) for result in actual[:-1]])
+        self.assertEqual([2, 3, 4, 5, 6], [result["policy_line"] for result in actual[:-1]])
+        self.assertEqual({"type": "summary", "files": 1, "pass": 3, "fail": 2, "error": 0},
+                         actual[-1])
+
+    def test_check_sections_as_editors(self):
+        conf = ("<Directory />\n    Dir2 a\n</directory>\nDir2 b\n"
+                "<Sec1>\n  <Sec1>\n  Dir2 c\n  </Sec1>\n  Dir2 d\n</Sec1>\n")
+        with open(self.policy_file, 'w') as f:
+            f.write("absent Dir2 -s Sec1\nabsent Dir2 -s directory -i\n")
+        _, actual = self.check([], conf)
+        self.assertEqual([[7], [2]], [result["lines"] for result in actual[:-1]])
+        # The lines found are those the editors change
+        for args, lines in ((["-s", "Sec1"], [7]), (["-s", "directory", "-i"], [2])):
+            edited = run([HTCONF, "disable", "Dir2"] + args, conf).splitlines()
+            self.assertEqual(lines, [lineno for lineno, line in enumerate(edited, 1)
+                                     if line.lstrip().startswith("#")])
+
+    def test_check_files_on_pool(self):
+        files = []
+        for i, conf in enumerate([SAMPLE, SAMPLE.replace("Dir1 None", "Dir1 Off")]):
+            files.append(os.path.join(self.tmp_dir.name, f"host{i}.conf"))
+            with open(files[-1], 'w') as f:
+                f.write(conf)
+        mtimes = [os.stat(file).st_mtime_ns for file in files]
+        status, actual = self.check(["-j", "2"] + files)
+        self.assertEqual(2, status)
+        self.assertEqual(files, [result["file"] for result in actual[:-1:5]])
+        self.assertEqual(("fail", [1]), (actual[5]["status"], actual[5]["lines"]))
+        self.assertEqual(mtimes, [os.stat(file).st_mtime_ns for file in files])
+
+    def test_check_unreadable_file(self):
+        status, actual = self.check([os.path.join(self.tmp_dir.name, "missing.conf")])
+        self.assertEqual(1, status)
+        self.assertEqual("error", actual[0]["type"])
+
+    def test_check_invalid_policy(self):
+        with open(self.policy_file, 'w') as f:
+            f.write("present Dir1\nrequire Dir2\n")
+        with self.assertRaises(RuntimeError) as cm:
+            run([HTCONF, "check", "-p", self.policy_file], SAMPLE)
+        self.assertIn("line 2", str(cm.exception))
+
+    def test_check_invalid_jobs(self):
+        with self.assertRaises(RuntimeError) as cm:
+            run([HTCONF, "check", "-p", self.policy_file, "-j", "-1"], SAMPLE)
+        self.assertIn("Invalid Number (-j -1)", str(cm.exception))
+
+
+class TestDryRun(unittest.TestCase):
+    def test_dry_run_diff_pipe(self):
+        outstream = io.StringIO()
+        status = htconf.main([
+            HTCONF,
+            "-e", "set Dir2 -v On -w None",
+            "-e", "add Dir9 -v XXX -s Sec2:/var/www",
+            "--dry-run", "--diff"
+        ], io.StringIO(SAMPLE), outstream)
+        expect = """--- -
++++ -
+@@ -3,11 +3,12 @@
+ Dir3 On \"($)+\"
+ Dir4 Off \"[*].?\"
+ <Sec1 />
+-    Dir2 None
++    Dir2 On
+     Dir2 \"\\\"a\\\\z\\\"\"
+     Dir4 On \"($)+\"
+     Dir4 Off \"($)+\"
+     <Sec2 \"/var/www\">
+         Dir4 Off \"[*].?\"
++        Dir9 XXX
+     </Sec2>
+ </Sec1>
+"""
+        self.assertEqual(htconf.EXIT_CHANGED, status)
+        self.assertEqual(expect, outstream.getvalue(), "Result should match expected output")
+
+    def test_dry_run_unchanged(self):
+        outstream = io.StringIO()
+        status = htconf.main([HTCONF, "set", "Dir9", "-v", "On", "--dry-run"],
+                             io.StringIO(SAMPLE), outstream)
+        self.assertEqual(0, status)
+        self.assertEqual("", outstream.getvalue())
+
+    def test_dry_run_file(self):
+        actual_file = os.path.join(tempfile.gettempdir(), "test_dry_run_file.conf")
+        with open(actual_file, 'w') as f:
+            f.write(SAMPLE)
+        outstream = io.StringIO()
+        status = htconf.main([HTCONF, "disable", "Dir1", "-f", actual_file,
+                              "--dry-run", "--diff"], io.StringIO(), outstream)
+        self.assertEqual(htconf.EXIT_CHANGED, status)
+        self.assertIn("-Dir1 None\n+#Dir1 None\n", outstream.getvalue())
+        with open(actual_file, 'r') as f:
+            self.assertEqual(SAMPLE, f.read())
+
+    def test_diff_file(self):
+        actual_file = os.path.join(tempfile.gettempdir(), "test_diff_file.conf")
+        with open(actual_file, 'w') as f:
+            f.write(SAMPLE)
+        outstream = io.StringIO()
+        status = htconf.main([HTCONF, "disable", "Dir1", "-f", actual_file, "--diff"],
+                             io.StringIO(), outstream)
+        self.assertEqual(0, status)
+        self.assertIn("-Dir1 None\n+#Dir1 None\n", outstream.getvalue())
+        with open(actual_file, 'r') as f:
+            self.assertEqual("#" + SAMPLE, f.read())
+
+
+class TestEditScript(unittest.TestCase):
+    EXPRESSIONS = ["-e", "set Dir2 -v On -w None", "-e", "add Dir9 -v XXX -s Sec2:/var/www"]
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.script_file = os.path.join(self.tmp_dir.name, "edit.json")
+        with open(self.script_file, 'w') as f:
+            f.write(run([HTCONF] + self.EXPRESSIONS + ["--script"], SAMPLE))
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_apply_patch_pipe(self):
+        expect = run([HTCONF] + self.EXPRESSIONS, SAMPLE)
+        actual = run([HTCONF, "apply-patch", self.script_file], SAMPLE)
+        self.assertEqual(expect, actual, "Result should match expected output")
+
+    def test_apply_patch_hash_mismatch(self):
+        conf = SAMPLE.replace("Dir1 None", "Dir2 None")
+        expect = run([HTCONF] + self.EXPRESSIONS, conf)
+        actual = run([HTCONF, "apply-patch", self.script_file], conf)
+        self.assertEqual(expect, actual, "Result should match expected output")
+
+    def test_apply_patch_file(self):
+        actual_file = os.path.join(self.tmp_dir.name, "test.conf")
+        with open(actual_file, 'w') as f:
+            f.write(SAMPLE)
+        self.assertEqual(htconf.EXIT_CHANGED, htconf.main(
+            [HTCONF, "apply-patch", self.script_file, "-f", actual_file, "--dry-run"]))
+        call([HTCONF, "apply-patch", self.script_file, "-f", actual_file])
+        with open(actual_file) as f:
+            self.assertEqual(run([HTCONF] + self.EXPRESSIONS, SAMPLE), f.read())
+
+    def test_apply_patch_invalid_script(self):
+        with open(self.script_file, 'w') as f:
+            f.write("{}")
+        with self.assertRaises(RuntimeError):
+            run([HTCONF, "apply-patch", self.script_file], SAMPLE)
+
+
+class TestImport(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def write(self, name, text):
+        path = os.path.join(self.tmp_dir.name, name)
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+    def test_import_csv_pipe(self):
+        rows_file = self.write("rows.csv", "section,directive,values\n"
+                                           "Sec2:/var/www,Dir5,On \"with space\"\n"
+                                           ",Dir6,Off\n"
+                                           "Sec3:/srv,Dir7,\n")
+        expect = run([
+            HTCONF,
+            "-e", "add Dir5 -v On -v 'with space' -s Sec2:/var/www",
+            "-e", "add Dir6 -v Off",
+            "-e", "add Dir7 -s Sec3:/srv"
+        ], SAMPLE)
+        actual = run([HTCONF, "import", rows_file], SAMPLE)
+        self.assertEqual(expect, actual, "Result should match expected output")
+
+    def test_import_json_file(self):
+        rows_file = self.write("rows.json", "[{\"section\": \"Sec1:/\", \"directive\": \"Dir5\", \"values\": [\"A\"]},"
+                                            " {\"section\": \"Sec1:/\", \"directive\": \"Dir6\", \"values\": \"B C\"}]")
+        actual_file = self.write("test.conf", SAMPLE)
+        self.assertEqual(htconf.EXIT_CHANGED, htconf.main(
+            [HTCONF, "import", rows_file, "-f", actual_file, "--dry-run"]))
+        call([HTCONF, "import", rows_file, "-f", actual_file])
+        with open(actual_file) as f:
+            self.assertEqual(SAMPLE.replace("</Sec1>", "    Dir5 A\n    Dir6 B C\n</Sec1>"), f.read())
+
+    def test_import_invalid_rows(self):
+        rows_file = self.write("rows.json", "{\"directive\": \"Dir5\"}\n{\"section\": \"Sec1\"}\n")
+        with self.assertRaises(RuntimeError) as cm:
+            run([HTCONF, "import", rows_file], SAMPLE)
+        self.assertIn("line 2", str(cm.exception))
+
+    def test_import_invalid_types(self):
+        for row, message in (("{\"directive\": 5}", "Directive"),
+                             ("{\"directive\": \"Dir5\", \"section\": [\"Sec1\"]}", "Section"),
+                             ("{\"directive\": \"Dir5\", \"values\": 5}", "Values")):
+            rows_file = self.write("rows.json", "{\"directive\": \"Dir5\"}\n" + row + "\n")
+            with self.assertRaises(RuntimeError) as cm:
+                run([HTCONF, "import", rows_file], SAMPLE)
+            self.assertIn(f"line 2: {message} must be", str(cm.exception))
+
+
+class TestCommand(unittest.TestCase):
+    def test_command_pipe(self):
+        actual = run_command([
+            HTCONF,
+            "-e", "add Dir4 -v XXX",
+            "-e", "set Dir2 -v On -w None"
+        ], SAMPLE)
+        expect = run([
+            HTCONF,
+            "-e", "add Dir4 -v XXX",
+            "-e", "set Dir2 -v On -w None"
+        ], SAMPLE)
+        self.assertEqual(expect, actual, "Result should match expected output")
+
+    def test_command_unknown_operation(self):
+        with self.assertRaises(RuntimeError):
+            run_command([HTCONF, "remove", "Dir2"], SAMPLE)
+        with self.assertRaises(RuntimeError):
+            run([HTCONF, "remove", "Dir2"], SAMPLE)
+
+
+class TestStartup(unittest.TestCase):
+    def test_startup_lazy_imports(self):
+        actual = subprocess.run([
+            "python3", "-c",
+            "import sys, htconf; print(' '.join(sorted(set(sys.modules) & "
+            "{'getopt', 'shlex', 'json', 'hashlib', 'tempfile', 'fnmatch', "
+            "'contextlib', 'concurrent.futures'})))"
+        ], text=True, capture_output=True, cwd=os.path.dirname(HTCONF)).stdout
+        self.assertEqual("\n", actual, "No module should be imported eagerly")
+
+    def test_startup_file_edit_not_queued(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            conf_file = os.path.join(tmp_dir, "httpd.conf")
+            with open(conf_file, "w") as f:
+                f.write(SAMPLE)
+            res = subprocess.run(["python3", "-X", "importtime", HTCONF, "set", "Dir1", "-v", "Off",
+                                  "-f", conf_file], text=True, capture_output=True, check=True)
+            with open(conf_file) as f:
+                self.assertEqual(SAMPLE.replace("Dir1 None", "Dir1 Off"), f.read())
+        imported = {line.split("|")[-1].strip() for line in res.stderr.splitlines()}
+        # No job is queued while nobody else holds the lock
+        self.assertEqual(set(), imported & {"tempfile", "hashlib", "json"})
+
+    def test_startup_import_budget(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            env = dict(os.environ, PYTHONPYCACHEPREFIX=tmp_dir)
+            env.pop("PYTHONDONTWRITEBYTECODE", None)
+            # Cache the bytecode at first
+            subprocess.run(["python3", "-c", "import htconf"], env=env,
+                           cwd=os.path.dirname(HTCONF), check=True)
+            res = subprocess.run(["python3", "-X", "importtime", "-c", "import htconf"],
+                                 env=env, text=True, capture_output=True,
+                                 cwd=os.path.dirname(HTCONF), check=True)
+        cumulative = [int(line.split("|")[1]) for line in res.stderr.splitlines()
+                      if line.split("|")[-1].strip() == "htconf"]
+        self.assertEqual(1, len(cumulative))
+        self.assertLess(cumulative[0], IMPORT_BUDGET_US)
+
+    def test_startup_zipapp(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            target = os.path.join(tmp_dir, "htconf.pyz")
+            subprocess.run(["python3", os.path.join(os.path.dirname(HTCONF), "htconf-zipapp.py"),
+                            "-o", target], check=True, capture_output=True)
+            actual = run_command([target, "set", "Dir2", "-v", "Off"], SAMPLE)
+        expect = run([HTCONF, "set", "Dir2", "-v", "Off"], SAMPLE)
+        self.assertEqual(expect, actual, "Result should match expected output")
+
+    def test_startup_cli_budget(self):
+        def cpu_time(args, env):
+            start = resource.getrusage(resource.RUSAGE_CHILDREN)
+            subprocess.run(args, input=SAMPLE, text=True, capture_output=True,
+                           env=env, check=True)
+            end = resource.getrusage(resource.RUSAGE_CHILDREN)
+            return end.ru_utime + end.ru_stime - start.ru_utime - start.ru_stime
+
+        def cost(args, env):
+            # Alternate with the bare interpreter so both see the same load
+            ratios = []
+            for _ in range(15):
+                start = cpu_time(["python3", "-c", "pass"], env)
+                ratios.append(cpu_time(args, env) / start - 1)
+            return statistics.median(ratios)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            env = dict(os.environ, PYTHONPYCACHEPREFIX=tmp_dir)
+            env.pop("PYTHONDONTWRITEBYTECODE", None)
+            conf_file = os.path.join(tmp_dir, "httpd.conf")
+            with open(conf_file, "w") as f:
+                f.write(SAMPLE)
+            # Cache the bytecode of htconflib at first
+            subprocess.run(["python3", HTCONF, "-h"], env=env, check=True, capture_output=True)
+            for args in (["set", "Dir2", "-v", "Off"],
+                         ["set", "Dir2", "-v", "Off", "-f", conf_file]):
+                with self.subTest(args=args):
+                    self.assertLess(cost(["python3", HTCONF] + args, env), CLI_BUDGET)
+
+
 if __name__ == '__main__':
     unittest.main()
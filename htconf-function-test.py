@@ -1,6 +1,17 @@
 #!/usr/bin/env python3
 # coding:utf-8
+import os
+import pickle
+import time
+import fcntl
+import signal
+import shutil
+import marshal
+import difflib
 import unittest
+import tempfile
+import multiprocessing
+from concurrent import futures
 import htconf
 
 
@@ -115,5 +126,569 @@ class TestGetIndent(unittest.TestCase):
         self.assertEqual(expect, actual, "Result should match expected output")
 
 
+class TestSplitArgs(unittest.TestCase):
+    def test_split_args_bare(self):
+        actual = htconf.split_args('alias_module  modules/mod_alias.so')
+        expect = ('alias_module', 'modules/mod_alias.so')
+        self.assertEqual(expect, actual, "Result should match expected output")
+
+    def test_split_args_quoted(self):
+        actual = htconf.split_args('"%h \\"%r\\" \\\\" common')
+        expect = ('%h "%r" \\', 'common')
+        self.assertEqual(expect, actual, "Result should match expected output")
+
+    def test_split_args_esc_conf(self):
+        value = 'he"llo\\w orl\\"d'
+        actual = htconf.split_args(htconf.esc_conf(value) + ' ' + htconf.esc_conf('x'))
+        expect = (value, 'x')
+        self.assertEqual(expect, actual, "Result should match expected output")
+
+    def test_split_args_single_quoted(self):
+        actual = htconf.split_args("'a b' c")
+        expect = ('a b', 'c')
+        self.assertEqual(expect, actual, "Result should match expected output")
+
+
+class TestParseLine(unittest.TestCase):
+    def test_parse_line_directive(self):
+        actual = htconf.parse_line('    Dir4 On "($)+"\n')
+        expect = ('    ', 'Dir4', ('On', '($)+'))
+        self.assertEqual(expect, actual, "Result should match expected output")
+
+    def test_parse_line_commented_directive(self):
+        actual = htconf.parse_line('#Dir4 On')
+        expect = ('', '#Dir4', ('On',))
+        self.assertEqual(expect, actual, "Result should match expected output")
+
+    def test_parse_line_comment(self):
+        actual = htconf.parse_line('    # Dir4 On')
+        expect = ('    ', '', ())
+        self.assertEqual(expect, actual, "Result should match expected output")
+
+    def test_parse_line_section(self):
+        actual = htconf.parse_line('    <Sec2 "/var/www">')
+        expect = ('    ', '<Sec2', ('/var/www',))
+        self.assertEqual(expect, actual, "Result should match expected output")
+
+    def test_parse_line_section_end(self):
+        actual = htconf.parse_line('    </Sec2>')
+        expect = ('    ', '</Sec2', ())
+        self.assertEqual(expect, actual, "Result should match expected output")
+
+
+class TestCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.conf_file = os.path.join(self.tmp_dir.name, 'httpd.conf')
+        with open(self.conf_file, 'w') as f:
+            f.write('Dir1 None\n<Sec1 />\n    Dir2 On\n</Sec1>\n')
+        os.environ['HTCONF_CACHE'] = os.path.join(self.tmp_dir.name, 'cache')
+
+    def tearDown(self):
+        del os.environ['HTCONF_CACHE']
+        self.tmp_dir.cleanup()
+
+    def test_cache_store_load(self):
+        self.assertIsNone(htconf.load_cache(self.conf_file))
+        parsed = htconf.load_conf(self.conf_file)
+        self.assertEqual(parsed, htconf.load_cache(self.conf_file))
+        self.assertEqual({'Dir1': [0], '<Sec1': [1], 'Dir2': [2], '</Sec1': [3]},
+                         parsed[1])
+
+    def test_cache_modified_file(self):
+        htconf.load_conf(self.conf_file)
+        with open(self.conf_file, 'a') as f:
+            f.write('Dir3 Off\n')
+        self.assertIsNone(htconf.load_cache(self.conf_file))
+
+    def test_cache_broken_file(self):
+        htconf.load_conf(self.conf_file)
+        path = htconf.cache_path(htconf.cache_dir(), htconf.cache_key(self.conf_file))
+        with open(path, 'wb') as f:
+            f.write(b'broken')
+        self.assertIsNone(htconf.load_cache(self.conf_file))
+        self.assertFalse(os.path.exists(path))
+
+    def test_cache_wrong_structure(self):
+        htconf.load_conf(self.conf_file)
+        path = htconf.cache_path(htconf.cache_dir(), htconf.cache_key(self.conf_file))
+        key = htconf.cache_key(self.conf_file)
+        version = htconf.cache_version()
+        for data in ((1, 5, None), [1, 2, 3], (version, key, None),
+                     (version, key, ((('', 'Dir1', ('None',)),), {'Dir1': [3]})),
+                     (version, key, ((('', 'Dir1', 'None'),), {'Dir1': [0]}))):
+            with open(path, 'wb') as f:
+                marshal.dump(data, f)
+            self.assertIsNone(htconf.load_cache(self.conf_file))
+            self.assertFalse(os.path.exists(path))
+            htconf.load_conf(self.conf_file)
+            with open(path, 'wb') as f:
+                marshal.dump(data, f)
+            htconf.Editor(['htconf', 'set', 'Dir1', '-v', 'Off']).edit_file(self.conf_file)
+            htconf.Editor(['htconf', 'set', 'Dir1', '-v', 'None']).edit_file(self.conf_file)
+
+    def test_cache_other_version(self):
+        htconf.load_conf(self.conf_file)
+        path = htconf.cache_path(htconf.cache_dir(), htconf.cache_key(self.conf_file))
+        with open(path, 'rb') as f:
+            version, key, parsed = marshal.load(f)
+        with open(path, 'wb') as f:
+            marshal.dump(((htconf.CACHE_VERSION, 0, 2, 7), key, parsed), f)
+        self.assertIsNone(htconf.load_cache(self.conf_file))
+
+    def test_cache_disabled(self):
+        os.environ['HTCONF_CACHE'] = '0'
+        htconf.load_conf(self.conf_file)
+        self.assertIsNone(htconf.load_cache(self.conf_file))
+
+    def test_cache_eviction(self):
+        directory = htconf.cache_dir()
+        os.makedirs(directory)
+        for i in range(htconf.CACHE_ENTRIES + 10):
+            with open(os.path.join(directory, f"{i}.idx"), 'wb') as f:
+                f.write(b'')
+        htconf.load_conf(self.conf_file)
+        self.assertEqual(htconf.CACHE_ENTRIES, len(os.listdir(directory)))
+        self.assertIsNotNone(htconf.load_cache(self.conf_file))
+
+    def test_cache_noop_edit(self):
+        htconf.load_conf(self.conf_file)
+        mtime = os.stat(self.conf_file).st_mtime_ns
+        htconf.Editor(['htconf', 'set', 'Dir9', '-v', 'On']).edit_file(self.conf_file)
+        self.assertEqual(mtime, os.stat(self.conf_file).st_mtime_ns)
+        htconf.Editor(['htconf', 'set', 'Dir2', '-v', 'Off']).edit_file(self.conf_file)
+        with open(self.conf_file, 'r') as f:
+            self.assertEqual('Dir1 None\n<Sec1 />\n    Dir2 Off\n</Sec1>\n', f.read())
+        self.assertIsNotNone(htconf.load_cache(self.conf_file))
+
+
+class TestPatch(unittest.TestCase):
+    LINES = [f"Dir{i} On\n" for i in range(20)]
+
+    def test_merge_changes_sequential(self):
+        patch = htconf.Patch(list(self.LINES))
+        patch.merge([(2, 2, ["A\n", "B\n"]), (5, 6, ["C\n"])])
+        # Edited line numbers are shifted by the insertion above
+        patch.merge([(3, 4, ["D\n"]), (9, 10, ["E\n"])])
+        self.assertEqual([[2, 2, ["A\n", "D\n"]], [5, 6, ["C\n"]], [7, 8, ["E\n"]]],
+                         patch.hunks)
+
+    def test_merge_changes_restored(self):
+        patch = htconf.Patch(list(self.LINES))
+        patch.merge([(3, 4, ["#Dir3 On\n"])])
+        patch.merge([(3, 4, ["Dir3 On\n"])])
+        self.assertEqual([], patch.hunks)
+
+    def test_patch_no_final_newline(self):
+        for conf in ("Dir1 On\n<Sec1 />\n</Sec1>\nDir2 On", "Dir1 On\n<Sec1 />\n</Sec1>", ""):
+            for expressions in (["add Dir3 -v X"], ["add Dir3 -s Sec2:/"], ["add Dir3 -s Sec1:/"],
+                                ["add Dir3", "add Dir4 -s Sec2:/", "disable Dir3"]):
+                editors = [htconf.compile_expression(expression) for expression in expressions]
+                patch = htconf.Patch()
+                expect = htconf.apply_editors(conf, editors, patch)
+                lines = list(patch.lines)
+                for start, end, new_lines in reversed(patch.hunks):
+                    lines[start:end] = new_lines
+                self.assertEqual(expect, "".join(lines), f"{conf!r} {expressions}")
+                # The added lines are never joined to the last line
+                self.assertTrue(all(line.split()[0] in ("Dir1", "Dir2", "Dir3", "Dir4", "#Dir3",
+                                                        "<Sec1", "</Sec1>", "<Sec2", "</Sec2>")
+                                    for line in expect.splitlines()), expect)
+
+    def test_format_diff(self):
+        patch = htconf.Patch(list(self.LINES))
+        patch.merge([(0, 1, ["X\n"]), (4, 4, ["Y\n"]), (15, 16, ["Z\n"]), (20, 20, ["W"])])
+        edited = list(self.LINES)
+        edited[15] = "Z\n"
+        edited[4:4] = ["Y\n"]
+        edited[0] = "X\n"
+        edited.append("W")
+        expect = "".join(difflib.unified_diff(self.LINES, edited, "a.conf", "a.conf")) \
+            .replace("+W", "+W\n\\ No newline at end of file\n")
+        actual = patch.format_diff("a.conf")
+        self.assertEqual(expect, actual, "Result should match expected output")
+
+
+class TestEditScript(unittest.TestCase):
+    CONF = "Dir1 On\n<Sec1 />\n    Dir2 \f Off\n</Sec1>\nDir3 On"
+    EDITORS = [htconf.Editor.compile("set", "Dir1", ["Off"]),
+               htconf.Editor.compile("add", "Dir4", ["On"], section="Sec1:/"),
+               htconf.Editor.compile("disable", "Dir3")]
+
+    def test_edit_script_same_as_editors(self):
+        script = htconf.EditScript.loads(htconf.EditScript.build(self.CONF, self.EDITORS).dumps())
+        expect = htconf.apply_editors(self.CONF, self.EDITORS)
+        self.assertEqual(expect, script.apply(self.CONF))
+        # A changed config falls back to the expressions
+        conf = self.CONF.replace("Dir3 On", "Dir3 Off\nDir5 On")
+        self.assertEqual(htconf.apply_editors(conf, self.EDITORS), script.apply(conf))
+
+    def test_edit_script_hunks_only(self):
+        script = htconf.EditScript.build(self.CONF, self.EDITORS)
+        script.editors = []
+        patch = htconf.Patch()
+        self.assertEqual(htconf.apply_editors(self.CONF, self.EDITORS), script.apply(self.CONF, patch))
+        self.assertEqual(script.hunks, patch.hunks)
+
+    def test_edit_script_no_final_newline(self):
+        conf = "<SecA x>\n    Alpha 1\n</SecA>"
+        editors = [htconf.Editor(["htconf", "add", "AlphaBeta", "-v", "On", "-v", "x|y"]),
+                   htconf.Editor(["htconf", "add", "Alpha", "-v", "{x}", "-s", "SecC:Off"])]
+        expect = htconf.apply_editors(conf, editors)
+        self.assertEqual(conf + "\nAlphaBeta On x|y\n<SecC Off>\n    Alpha {x}\n</SecC>\n", expect)
+        script = htconf.EditScript.build(conf, editors)
+        self.assertEqual(expect, script.apply(conf))
+        script.editors = []
+        self.assertEqual(expect, script.apply(conf))
+
+    def test_edit_script_invalid(self):
+        for text in ("[]", "{\"version\": 2}",
+                     "{\"version\": 1, \"sha256\": \"\", \"hunks\": [[2, 1, []]], \"expressions\": []}",
+                     "{\"version\": 1, \"sha256\": \"\", \"hunks\": [], \"expressions\": [[\"drop\", \"Dir1\"]]}"):
+            with self.assertRaises(htconf.ExpressionError):
+                htconf.EditScript.loads(text)
+
+
+class RecordingObserver(htconf.Observer):
+    def __init__(self):
+        self.events = []
+
+    def on_match(self, editor, lineno, old, new):
+        self.events.append(("match", editor.directive, lineno, old, new))
+
+    def on_section_enter(self, editor, lineno, line):
+        self.events.append(("enter", editor.directive, lineno))
+
+    def on_section_exit(self, editor, lineno, line):
+        self.events.append(("exit", editor.directive, lineno))
+
+    def on_file_done(self, stats):
+        self.events.append(("done", stats["file"], stats["editors"], stats["changes"], stats["changed"]))
+
+
+class TestObserver(unittest.TestCase):
+    CONF = "Dir1 On\n<Sec1 />\n    Dir1 Off\n</Sec1>\n"
+
+    def test_observer_expressions(self):
+        observer = RecordingObserver()
+        expressions = htconf.Expressions()
+        expressions.add(htconf.Editor.compile("set", "Dir1", ["Off"], section="Sec1:/"))
+        expressions.observe(observer)
+        expressions.add(htconf.Editor.compile("add", "Dir2", ["On"]))
+        expressions.edit_text(self.CONF)
+        self.assertEqual([("enter", "Dir1", 2),
+                          ("match", "Dir1", 3, "    Dir1 Off\n", "    Dir1 Off\n"),
+                          ("exit", "Dir1", 4),
+                          ("match", "Dir2", 5, None, "Dir2 On\n"),
+                          ("done", None, 2, 1, True)], observer.events)
+
+    def test_observer_copy(self):
+        observer = RecordingObserver()
+        editor = htconf.Editor.compile("disable", "Dir1")
+        observed = editor.observe(observer)
+        self.assertEqual(editor.edit_text(self.CONF), observed.edit_text(self.CONF))
+        self.assertEqual(2, len(observer.events))
+        editor.edit_text(self.CONF)
+        self.assertEqual((), editor.observers)
+        self.assertEqual(2, len(observer.events))
+
+    def test_observer_file_done(self):
+        observer = RecordingObserver()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            file_path = os.path.join(tmp_dir, "test.conf")
+            with open(file_path, 'w') as f:
+                f.write(self.CONF)
+            htconf.edit_file(file_path, [htconf.Editor.compile("enable", "Dir1").observe(observer)])
+        self.assertEqual([("done", file_path, 1, 0, False)], observer.events)
+
+
+class TestImporter(unittest.TestCase):
+    CONF = """Dir1 On
+<Sec1 />
+    Dir2 Off
+    <Sec2 /var/www>
+    </Sec2>
+</Sec1>
+<Sec2 /srv>
+</Sec2>
+"""
+    ROWS = [
+        {"section": "Sec2:/srv", "directive": "Dir3", "values": ["A"]},
+        {"section": "", "directive": "Dir4", "values": []},
+        {"section": "Sec2", "directive": "Dir5", "values": ["with space"]},
+        {"section": "Sec3:/opt", "directive": "Dir6", "values": ["B"]},
+        {"section": "Sec1:/", "directive": "Dir7", "values": ["C"]},
+        {"section": "Sec3", "directive": "Dir8", "values": []},
+        {"section": "Sec2:/srv", "directive": "Dir9", "values": ["D"]},
+    ]
+
+    def test_importer_same_as_add(self):
+        importer = htconf.Importer(self.ROWS)
+        patch = htconf.Patch()
+        expect_patch = htconf.Patch()
+        expect = htconf.apply_editors(self.CONF, importer.editors, expect_patch)
+        self.assertEqual(expect, importer.apply(self.CONF, patch))
+        self.assertEqual(expect_patch.hunks, patch.hunks)
+        # All rows of a section are inserted together
+        self.assertEqual([[4, 4, ["        Dir5 \"with space\"\n"]],
+                          [5, 5, ["    Dir7 C\n"]],
+                          [7, 7, ["    Dir3 A\n", "    Dir5 \"with space\"\n", "    Dir9 D\n"]],
+                          [8, 8, ["Dir4\n", "<Sec3 /opt>\n", "    Dir6 B\n", "    Dir8\n", "</Sec3>\n"]]],
+                         patch.hunks)
+
+    def test_importer_no_final_newline(self):
+        importer = htconf.Importer(self.ROWS)
+        for conf in (self.CONF.rstrip("\n"), self.CONF.rstrip("\n") + "\nDir1 On"):
+            patch = htconf.Patch()
+            expect = htconf.apply_editors(conf, importer.editors)
+            self.assertEqual(expect, importer.apply(conf, patch))
+            lines = list(patch.lines)
+            for start, end, new_lines in reversed(patch.hunks):
+                lines[start:end] = new_lines
+            self.assertEqual(expect, "".join(lines))
+
+    def test_read_rows(self):
+        expect = [{"section": "Sec1:/", "directive": "Dir1", "values": ["A", "b c"]},
+                  {"section": "", "directive": "Dir2", "values": []}]
+        csv_rows = "directive,values,section\nDir1,A \"b c\",Sec1:/\nDir2,,\n"
+        json_lines = "{\"section\": \"Sec1:/\", \"directive\": \"Dir1\", \"values\": [\"A\", \"b c\"]}\n" \
+                     "\n{\"directive\": \"Dir2\"}\n"
+        self.assertEqual(expect, htconf.read_rows(csv_rows, "csv"))
+        self.assertEqual(expect, htconf.read_rows(json_lines))
+        self.assertEqual(expect, htconf.read_rows("[" + ",".join(json_lines.split("\n")[::2]) + "]"))
+        for text in ("{\"values\": [\"A\"]}", "{\"directive\": \"Dir1\", \"values\": [1]}", "[1]", "{"):
+            with self.assertRaises(htconf.ExpressionError):
+                htconf.read_rows(text)
+
+
+class TestCompile(unittest.TestCase):
+    CONF = 'Listen 80\n<VirtualHost *:80>\n    ServerName a\n</VirtualHost>\n'
+
+    def test_compile_same_as_argv(self):
+        editor = htconf.Editor.compile(op='set', directive='ServerName', values=['b c'],
+                                       where=['a'], section='VirtualHost:*:80')
+        expect = htconf.Editor(['htconf', 'set', 'ServerName', '-v', 'b c', '-w', 'a',
+                                '-s', 'VirtualHost:*:80']).edit_text(self.CONF)
+        actual = editor.edit_text(self.CONF)
+        self.assertEqual(expect, actual, "Result should match expected output")
+        self.assertIn('    ServerName "b c"\n', actual)
+        self.assertEqual(['set', 'ServerName', '-v', 'b c', '-w', 'a', '-s', 'VirtualHost:*:80'],
+                         editor.argv)
+
+    def test_compile_immutable(self):
+        editor = htconf.Editor.compile(op='set', directive='Listen', values=['8080'])
+        with self.assertRaises(AttributeError):
+            editor.values = ' 443'
+        self.assertEqual('Listen 8080\n', editor.edit_text('Listen 80\n'))
+        self.assertEqual('Listen 8080\n', editor.edit_text('Listen 443\n'))
+
+    def test_compile_pickle(self):
+        editor = htconf.Editor.compile(op='disable', directive='ServerName', where=['?'],
+                                       match='glob')
+        copied = pickle.loads(pickle.dumps(editor))
+        self.assertEqual(editor.edit_text(self.CONF), copied.edit_text(self.CONF))
+        self.assertIn('    #ServerName a\n', copied.edit_text(self.CONF))
+        with self.assertRaises(AttributeError):
+            copied.match = 'exact'
+
+    def test_compile_errors(self):
+        with self.assertRaises(htconf.ExpressionError):
+            htconf.Editor.compile(op='remove', directive='Listen')
+        with self.assertRaises(htconf.ExpressionError):
+            htconf.Editor.compile(op='add', directive='<VirtualHost>')
+        with self.assertRaises(htconf.ExpressionError):
+            htconf.Editor.compile(op='set', directive='Listen', where=['('], match='regex')
+        with self.assertRaises(htconf.ExpressionError):
+            htconf.Editor.compile(op='set', directive='Listen', values='8080')
+        with self.assertRaises(htconf.ExpressionError):
+            htconf.Editor.compile(op='set', directive='Listen', where='80')
+        with self.assertRaises(htconf.ExpressionError):
+            htconf.Editor.compile(op='set', directive='Listen', values=[1])
+        with self.assertRaises(htconf.ExpressionError):
+            htconf.Editor.compile(op='set', directive=None)
+        with self.assertRaises(htconf.ExpressionError):
+            htconf.Editor(['htconf', 'set', 'Listen', '-x'])
+
+
+def add_directive(conf_file, name):
+    htconf.Editor(['htconf', 'add', name, '-v', 'On']).edit_file(conf_file)
+
+
+def add_directive_interrupted(conf_file, name):
+    try:
+        add_directive(conf_file, name)
+    except KeyboardInterrupt:
+        pass
+
+
+class TestLock(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.conf_file = os.path.join(self.tmp_dir.name, 'httpd.conf')
+        with open(self.conf_file, 'w') as f:
+            f.write('Dir1 None\n')
+
+    def tearDown(self):
+        shutil.rmtree(htconf.queue_dir(self.conf_file), ignore_errors=True)
+        self.tmp_dir.cleanup()
+
+    def edit_while_locked(self, editor: htconf.Editor) -> bool:
+        """Edit the file in a thread, queueing its job while the lock is held"""
+        directory = htconf.queue_dir(self.conf_file)
+        queued = set(os.listdir(directory))
+        with futures.ThreadPoolExecutor(max_workers=1) as executor, open(self.conf_file) as conf_file:
+            fcntl.flock(conf_file, fcntl.LOCK_EX)
+            future = executor.submit(editor.edit_file, self.conf_file)
+            while not any(name.endswith('.job') for name in set(os.listdir(directory)) - queued):
+                time.sleep(0.01)
+            fcntl.flock(conf_file, fcntl.LOCK_UN)
+            return future.result()
+
+    def test_editor_edit(self):
+        htconf.Editor(['htconf', 'set', 'Dir1', '-v', 'Off', '-f', self.conf_file]).edit()
+        with open(self.conf_file, 'r') as f:
+            self.assertEqual('Dir1 Off\n', f.read())
+
+    def test_lock_coalesce_queued_jobs(self):
+        directory = htconf.queue_dir(self.conf_file)
+        jobs = [htconf.enqueue_job(directory, [htconf.Editor(['htconf', 'add', 'Dir2', '-v', 'A'])]),
+                htconf.enqueue_job(directory, [htconf.Editor(['htconf', 'set', 'Dir2', '-v', 'B'])])]
+        self.assertTrue(self.edit_while_locked(htconf.Editor(['htconf', 'add', 'Dir3', '-v', 'C'])))
+        with open(self.conf_file, 'r') as f:
+            self.assertEqual('Dir1 None\nDir2 B\nDir3 C\n', f.read())
+        # The results are left for the waiting processes
+        self.assertEqual(sorted(path + '.changed' for path, _ in jobs),
+                         sorted(os.path.join(directory, name) for name in os.listdir(directory)))
+        for _, job_file in jobs:
+            job_file.close()
+
+    def test_lock_patch_not_coalesced(self):
+        directory = htconf.queue_dir(self.conf_file)
+        path, job_file = htconf.enqueue_job(directory, [htconf.Editor(['htconf', 'add', 'Dir2', '-v', 'A'])])
+        patch = htconf.Patch()
+        self.assertTrue(htconf.edit_file(self.conf_file, [htconf.Editor(['htconf', 'set', 'Dir1', '-v', 'Off'])],
+                                         patch=patch))
+        with open(self.conf_file, 'r') as f:
+            self.assertEqual('Dir1 Off\n', f.read())
+        self.assertEqual('-Dir1 None\n+Dir1 Off\n',
+                         ''.join(line for line in patch.format_diff().splitlines(True)
+                                 if line[0] in '+-' and line[:3] not in ('---', '+++')))
+        # The queued job is left to the next process
+        self.assertEqual([path], [os.path.join(directory, name) for name in os.listdir(directory)])
+        self.edit_while_locked(htconf.Editor(['htconf', 'set', 'Dir1', '-v', 'On']))
+        with open(self.conf_file, 'r') as f:
+            self.assertEqual('Dir1 On\nDir2 A\n', f.read())
+        job_file.close()
+
+    def test_lock_stale_jobs_removed(self):
+        directory = htconf.queue_dir(self.conf_file)
+        # A process killed while waiting, and results left for exited processes
+        path, job_file = htconf.enqueue_job(directory, [htconf.Editor(['htconf', 'add', 'Dir2', '-v', 'A'])])
+        job_file.close()
+        for suffix in ('.changed', '.claimed'):
+            with open(path + suffix, 'w') as f:
+                f.write('[]')
+        self.edit_while_locked(htconf.Editor(['htconf', 'set', 'Dir1', '-v', 'Off']))
+        with open(self.conf_file, 'r') as f:
+            self.assertEqual('Dir1 Off\n', f.read())
+        self.assertFalse(os.path.exists(directory))
+
+    def test_lock_claimed_job_not_applied_again(self):
+        directory = htconf.queue_dir(self.conf_file)
+        # A job claimed by a process that exited before leaving its result
+        path, job_file = htconf.enqueue_job(directory, [htconf.Editor(['htconf', 'add', 'Dir2', '-v', 'A'])])
+        os.rename(path, path + '.claimed')
+        self.edit_while_locked(htconf.Editor(['htconf', 'set', 'Dir1', '-v', 'Off']))
+        with open(self.conf_file, 'r') as f:
+            self.assertEqual('Dir1 Off\n', f.read())
+        self.assertEqual([path + '.claimed'], [os.path.join(directory, name) for name in os.listdir(directory)])
+        job_file.close()
+
+    def test_lock_interrupted_waiter(self):
+        directory = htconf.queue_dir(self.conf_file)
+        with open(self.conf_file, 'r') as conf_file:
+            fcntl.flock(conf_file, fcntl.LOCK_EX)
+            process = multiprocessing.Process(target=add_directive_interrupted,
+                                              args=(self.conf_file, 'Cancelled'))
+            process.start()
+            while not any(name.endswith('.job') for name in os.listdir(directory)):
+                time.sleep(0.01)
+            os.kill(process.pid, signal.SIGINT)
+            process.join()
+        self.assertFalse(os.path.exists(directory))
+        htconf.Editor(['htconf', 'set', 'Dir1', '-v', 'Off']).edit_file(self.conf_file)
+        with open(self.conf_file, 'r') as f:
+            self.assertEqual('Dir1 Off\n', f.read())
+
+    def test_lock_concurrent_edits(self):
+        names = [f"Dir{i}" for i in range(2, 18)]
+        processes = [multiprocessing.Process(target=add_directive, args=(self.conf_file, name))
+                     for name in names]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        with open(self.conf_file, 'r') as f:
+            lines = f.read().splitlines()
+        self.assertEqual(['Dir1 None'] + sorted(f"{name} On" for name in names),
+                         ['Dir1 None'] + sorted(lines[1:]))
+        self.assertEqual([], os.listdir(htconf.queue_dir(self.conf_file)))
+
+
+class TestThreads(unittest.TestCase):
+    EXPRESSIONS = ["set Dir1 -v On -w None", "add Dir9 -v X -s Sec1:/", "disable Dir2 -s Sec1:/",
+                   "enable Dir3 -v Off", "set '<Sec2>' -v /srv -w /var/www"]
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.expressions = htconf.Expressions()
+        for expression in self.EXPRESSIONS:
+            self.expressions.add(htconf.compile_expression(expression))
+        self.confs = []
+        for i in range(48):
+            conf = f"Dir1 {'None' if i % 2 else 'Off'}\n#Dir3 On\n"
+            if i % 3:
+                conf += f"<Sec1 />\n    Dir2 {i}\n    <Sec2 /var/www>\n    </Sec2>\n</Sec1>\n"
+            self.confs.append(conf)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def write_files(self, name: str) -> list:
+        file_paths = []
+        for i, conf in enumerate(self.confs):
+            file_paths.append(os.path.join(self.tmp_dir.name, f"{name}{i}.conf"))
+            with open(file_paths[-1], 'w') as f:
+                f.write(conf)
+        return file_paths
+
+    def test_expressions_not_shared(self):
+        self.assertEqual((), htconf.Expressions().editors)
+        self.assertEqual(len(self.EXPRESSIONS), len(self.expressions.editors))
+
+    def test_add_threads(self):
+        expressions = htconf.Expressions()
+        editor = htconf.compile_expression("add Dir9 -v X")
+        with futures.ThreadPoolExecutor(max_workers=16) as executor:
+            list(executor.map(lambda _: [expressions.add(editor) for _ in range(100)], range(16)))
+        self.assertEqual(1600, len(expressions.editors))
+
+    def test_edit_text_threads(self):
+        expect = [self.expressions.edit_text(conf) for conf in self.confs] * 8
+        with futures.ThreadPoolExecutor(max_workers=16) as executor:
+            actual = list(executor.map(self.expressions.edit_text, self.confs * 8))
+        self.assertEqual(expect, actual)
+
+    def test_edit_files_threads(self):
+        sequential = self.write_files("sequential")
+        concurrent = self.write_files("concurrent")
+        expect = [self.expressions.edit_file(file_path) for file_path in sequential * 2]
+        actual = self.expressions.edit_files(concurrent * 2, workers=16)
+        self.assertEqual(expect[:len(self.confs)], actual[:len(self.confs)])
+        for sequential_file, concurrent_file in zip(sequential, concurrent):
+            with open(sequential_file) as f, open(concurrent_file) as g:
+                self.assertEqual(f.read(), g.read())
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+# coding:utf-8
+import os
+import sys
+import io
+import time
+import json
+import random
+import shlex
+import shutil
+import getopt
+import tempfile
+import contextlib
+import subprocess
+import htconf
+
+
+def usage(output=sys.stdout):
+    """usage output"""
+    print('''
+Usage: htconf-fuzz.py [options]
+Differential fuzzing of htconf.py against htconf.sh
+Differences where htconf.sh matches a prefix of a name or value are
+counted as expected, and only the other mismatches fail.
+
+Options:
+        -n COUNT      Number of cases (default: 100)
+        -s SEED       Random seed (default: current time)
+        -l LINES      Maximum number of directives per config (default: 30)
+        -o FILE       Write the per-case report as JSON lines
+''', file=output)
+
+
+# Some names and values are prefixes of others. htconf.py matches whole
+# tokens while htconf.sh matches prefixes, so the cases where an expression
+# word prefixes a config word are expected to differ and reported separately.
+DIRECTIVES = ['Alpha', 'Bravo', 'Charlie', 'Delta', 'Echo', 'AlphaBeta', 'Delta2']
+SECTIONS = ['SecA', 'SecB', 'SecC', 'SecAB']
+VALUES = ['On', 'Off', 'None', '/var/www', '/var', 'a.b', '($)+', '[*].?',
+          '{x}', 'x|y', '^z$', 'with space', 'with"quote', 'with\\slash', 'Nonesuch']
+# htconf.sh escapes quotes before backslashes in esc_regexp, so it never
+# matches a -w value containing a backslash.
+WITH_VALUES = [value for value in VALUES if '\\' not in value]
+OPERATIONS = ['add', 'set', 'disable', 'enable']
+
+
+def random_config(rand: random.Random, max_lines: int) -> str:
+    """Generate a random config text"""
+    lines = []
+    stack = []
+    for _ in range(rand.randint(1, max_lines)):
+        indent = '    ' * len(stack)
+        choice = rand.random()
+        if choice < 0.15 and len(stack) < 3:
+            name = rand.choice(SECTIONS)
+            lines.append(f"{indent}<{name} {htconf.esc_conf(rand.choice(VALUES))}>")
+            stack.append(name)
+        elif choice < 0.25 and stack:
+            lines.append(f"{'    ' * (len(stack) - 1)}</{stack.pop()}>")
+        else:
+            comment = '#' if rand.random() < 0.2 else ''
+            values = ''.join(' ' + htconf.esc_conf(rand.choice(VALUES))
+                             for _ in range(rand.randint(1, 3)))
+            lines.append(f"{indent}{comment}{rand.choice(DIRECTIVES)}{values}")
+    while stack:
+        lines.append(f"{'    ' * (len(stack) - 1)}</{stack.pop()}>")
+    return '\n'.join(lines) + '\n'
+
+
+def random_expression(rand: random.Random) -> list:
+    """Generate a random expression as an argument list"""
+    operation = rand.choice(OPERATIONS)
+    if operation == 'set' and rand.random() < 0.2:
+        args = [operation, f"<{rand.choice(SECTIONS)}>"]
+    else:
+        args = [operation, rand.choice(DIRECTIVES)]
+    for _ in range(rand.randint(0 if operation != 'add' else 1, 2)):
+        args += ['-v', rand.choice(VALUES)]
+    if operation != 'add':
+        for _ in range(rand.randint(0, 2)):
+            args += ['-w', rand.choice(WITH_VALUES)]
+    if rand.random() < 0.4:
+        args += ['-s', f"{rand.choice(SECTIONS)}:{rand.choice(VALUES[:7])}"]
+    return args
+
+
+def prefix_collision(expressions: list, conf: str) -> bool:
+    """Whether a name or value of the expressions is a proper prefix of a word
+    of the config or of the expressions"""
+    words = set()
+    for _, name, args in map(htconf.parse_line, conf.splitlines()):
+        words.add(name.lstrip('#</'))
+        words.update(args)
+    used = set()
+    for args in expressions:
+        used.add(args[1].strip('<>'))
+        for opt, value in zip(args, args[1:]):
+            if opt == '-w':
+                used.add(value)
+            elif opt == '-s':
+                used.update(value.split(':', 1))
+            elif opt == '-v':
+                # Written by the expression for the later ones
+                words.add(value)
+    words.update(args[1].strip('<>') for args in expressions)
+    return any(word != prefix and word.startswith(prefix) for prefix in used for word in words)
+
+
+def run_python(args: list, conf: str) -> str:
+    """Run htconf.py in process"""
+    outstream = io.StringIO()
+    with contextlib.redirect_stderr(io.StringIO()):
+        htconf.main(['htconf'] + args, io.StringIO(conf), outstream)
+    return outstream.getvalue()
+
+
+def run_shell(command: str, args: list, conf: str) -> str:
+    """Run htconf.sh as a subprocess"""
+    res = subprocess.run([command] + args, input=conf,
+                         text=True, capture_output=True)
+    return res.stdout
+
+
+def fuzz(count: int, seed: int, max_lines: int, report=None) -> int:
+    """Run the cases and return the number of mismatches"""
+    rand = random.Random(seed)
+    mismatches = 0
+    expected = 0
+    elapsed = {'python': 0.0, 'shell': 0.0}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # htconf.sh calls itself by $0 for -e, so it must be executable
+        command = os.path.join(tmp_dir, 'htconf')
+        shutil.copy(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'htconf.sh'),
+                    command)
+        os.chmod(command, 0o755)
+        for case in range(count):
+            conf = random_config(rand, max_lines)
+            expressions = [random_expression(rand)
+                           for _ in range(rand.randint(1, 3))]
+            if len(expressions) == 1:
+                args = expressions[0]
+            else:
+                args = []
+                for expression in expressions:
+                    args += ['-e', ' '.join(shlex.quote(arg) for arg in expression)]
+
+            start = time.perf_counter()
+            python_output = run_python(args, conf)
+            python_time = time.perf_counter() - start
+            start = time.perf_counter()
+            shell_output = run_shell(command, args, conf)
+            shell_time = time.perf_counter() - start
+            elapsed['python'] += python_time
+            elapsed['shell'] += shell_time
+
+            matched = python_output.rstrip('\n') == shell_output.rstrip('\n')
+            collision = prefix_collision(expressions, conf)
+            if not matched and collision:
+                expected += 1
+            elif not matched:
+                mismatches += 1
+                print(f"Mismatch (case {case}): {args}", file=sys.stderr)
+            if report:
+                print(json.dumps({
+                    'case': case, 'args': args, 'config': conf, 'matched': matched,
+                    'expected': not matched and collision,
+                    'python': {'time': python_time, 'output': python_output},
+                    'shell': {'time': shell_time, 'output': shell_output},
+                }), file=report)
+
+    print(f"seed={seed} cases={count} mismatches={mismatches} expected={expected} "
+          f"python={elapsed['python']:.3f}s shell={elapsed['shell']:.3f}s")
+    return mismatches
+
+
+##
+# Main
+##
+if __name__ == '__main__':
+    count = 100
+    seed = time.time_ns()
+    max_lines = 30
+    report_path = ''
+    try:
+        options, _ = getopt.getopt(sys.argv[1:], 'n:s:l:o:h', ['help'])
+    except getopt.GetoptError as e:
+        print(e, file=sys.stderr)
+        usage(sys.stderr)
+        sys.exit(1)
+    for opt, optarg in options:
+        if opt == '-n':
+            count = int(optarg)
+        elif opt == '-s':
+            seed = int(optarg)
+        elif opt == '-l':
+            max_lines = int(optarg)
+        elif opt == '-o':
+            report_path = optarg
+        elif opt in ('-h', '--help'):
+            usage()
+            sys.exit(0)
+
+    if report_path:
+        with open(report_path, 'w') as report:
+            mismatches = fuzz(count, seed, max_lines, report)
+    else:
+        mismatches = fuzz(count, seed, max_lines)
+    sys.exit(1 if mismatches else 0)
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# coding:utf-8
+import os
+import sys
+import getopt
+import zipapp
+import tempfile
+import py_compile
+
+MAIN = '''import sys
+import htconflib
+sys.exit(htconflib.main(sys.argv))
+'''
+
+
+def usage(output=sys.stdout):
+    """usage output"""
+    print('''
+Usage: htconf-zipapp.py [options]
+Build htconf as a single-file zipapp with precompiled bytecode
+
+Options:
+        -o FILE       Output file (default: dist/htconf.pyz)
+        -p PYTHON     Interpreter of the shebang line (default: /usr/bin/env python3)
+
+The bytecode only runs on the Python version building the zipapp.
+''', file=output)
+
+
+def build(target: str, interpreter: str = '/usr/bin/env python3'):
+    """Build the zipapp of htconflib.py"""
+    source = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'htconflib.py')
+    with tempfile.TemporaryDirectory() as build_dir:
+        # zipimport loads a sourceless htconflib.pyc at the root of the archive
+        py_compile.compile(source, cfile=os.path.join(build_dir, 'htconflib.pyc'),
+                           dfile='htconflib.py', doraise=True, optimize=2,
+                           invalidation_mode=py_compile.PycInvalidationMode.UNCHECKED_HASH)
+        with open(os.path.join(build_dir, '__main__.py'), 'w') as main_file:
+            main_file.write(MAIN)
+        os.makedirs(os.path.dirname(os.path.abspath(target)), exist_ok=True)
+        zipapp.create_archive(build_dir, target, interpreter=interpreter)
+
+
+##
+# Main
+##
+if __name__ == '__main__':
+    target = os.path.join('dist', 'htconf.pyz')
+    interpreter = '/usr/bin/env python3'
+    try:
+        options, _ = getopt.getopt(sys.argv[1:], 'o:p:h', ['help'])
+    except getopt.GetoptError as e:
+        print(e, file=sys.stderr)
+        usage(sys.stderr)
+        sys.exit(1)
+    for opt, optarg in options:
+        if opt == '-o':
+            target = optarg
+        elif opt == '-p':
+            interpreter = optarg
+        elif opt in ('-h', '--help'):
+            usage()
+            sys.exit(0)
+    build(target, interpreter)
+    print(target)
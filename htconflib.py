@@ -0,0 +1,1930 @@
+#!/usr/bin/env python3
+# coding:utf-8
+import os
+import sys
+import io
+import re
+# Other modules are imported where they are used to keep the start fast
+
+
+def usage(output=sys.stdout):
+    """usage output"""
+    print('''
+Usage: htconf [operation] [NAME] [options]              Edit text as pipe
+   or: htconf [operation] [NAME] [options] -f [file]    Edit text file
+   or: htconf -e "[ARGS]" -e "[ARGS]" ...               Edit text with multiple operations as a pipe
+   or: htconf -e "[ARGS]" -e "[ARGS]" ... -f [file]     Edit text file with multiple operations
+   or: htconf batch [-j JOBS]                           Run NDJSON jobs from stdin
+   or: htconf dump [--format FORMAT] [-f file] ...      Export directives as json or msgpack records
+   or: htconf drift [-j JOBS] [-t RATIO] [file] ...     Report settings drifting from the fleet baseline
+   or: htconf check -p POLICY [-j JOBS] [file] ...      Check configs against a policy of assertions
+   or: htconf apply-patch SCRIPT [-f file]              Apply an edit script made with --script
+   or: htconf import ROWS [--format FORMAT] [-f file]   Add directives of json or csv rows in one pass
+   or: htconf --help                                    Show usage information
+Edit Apache configuration directives (stdin or file)
+
+Arguments:
+        operation     add, set, disable, enable
+        NAME          Directive name
+                      If it is a section directive name, enclose it with "<" and ">"
+Options:
+        -v VALUE      Value of the directive to set
+        -w VALUE      Matching Directive Value
+        -s SECTION    Matching Directive Section
+                      Format: <Section Name>:<Section Value>
+        --match=MODE  How -w and -s values match the arguments
+                      exact (default), prefix, glob, regex
+        -i            Match directive and section names case-insensitively
+        -f FILE       Editing file
+        -e ARGS       [operation] [NAME] [options] as string
+        --dry-run     Do not write, exit with 2 if anything would change
+        --diff        Output a unified diff of the changes
+        --script      Output an edit script of the changes instead of editing
+Environment:
+        HTCONF_CACHE  Cache parsed files when editing with -f
+                      "1" to use $XDG_CACHE_HOME/htconf, or a directory path
+''', file=output)
+
+
+def esc_conf(string: str) -> str:
+    """Escape strings for config values"""
+    if ' ' in string or '"' in string or '\\' in string:
+        return '"' + string.replace('\\', '\\\\').replace('"', '\\"') + '"'
+    else:
+        return string
+
+
+def esc_regexp(string: str) -> str:
+    """Escape strings for regular expressions"""
+    return '"?' + string.replace('"', '\\"') \
+        .replace('\\', '\\\\') \
+        .replace('.', '\\.') \
+        .replace('^', '\\^') \
+        .replace('$', '\\$') \
+        .replace('*', '\\*') \
+        .replace('+', '\\+') \
+        .replace('?', '\\?') \
+        .replace('{', '\\{') \
+        .replace('}', '\\}') \
+        .replace('(', '\\(') \
+        .replace(')', '\\)') \
+        .replace('[', '\\[') \
+        .replace(']', '\\]') \
+        .replace('|', '\\|') + '"?'
+
+
+MATCH_MODES = ('exact', 'prefix', 'glob', 'regex')
+# Exit status of --dry-run when the config would be changed
+EXIT_CHANGED = 2
+
+
+def compile_value(value: str, match: str):
+    """Compile the matching value for the match mode"""
+    if match == 'glob':
+        import fnmatch
+        return re.compile(fnmatch.translate(value))
+    if match == 'regex':
+        return re.compile(value)
+    return value
+
+
+def get_indent(string: str) -> str:
+    """Get indent from string"""
+    return string[:len(string) - len(string.lstrip())]
+
+
+TOKEN_PATTERN = re.compile(r'"((?:[^"\\]|\\.)*)"|\'((?:[^\'\\]|\\.)*)\'|(\S+)')
+UNESCAPE_PATTERN = re.compile(r'\\([\\"\'])')
+
+
+def split_args(string: str) -> tuple:
+    """Split directive arguments with the quoting rules of Apache"""
+    args = []
+    for double, single, bare in TOKEN_PATTERN.findall(string):
+        token = double or single or bare
+        args.append(UNESCAPE_PATTERN.sub(r'\1', token) if '\\' in token else token)
+    return tuple(args)
+
+
+def parse_line(line: str) -> tuple:
+    """Parse a line into (indent, name, args)
+
+    name is prefixed with "#" for a commented out directive, "<" for a section
+    and "</" for the end of a section, and is empty for blank and comment lines.
+    """
+    body = line.strip()
+    if not body:
+        return ('', '', ())
+    indent = get_indent(line)
+    if body[0] == '#':
+        if len(body) > 1 and body[1].isalpha():
+            _, name, args = parse_line(body[1:])
+            return (indent, '#' + name, args)
+        return (indent, '', ())
+    if body[0] == '<':
+        body = body[:-1] if body[-1] == '>' else body
+        if body[1:2] == '/':
+            return (indent, body.rstrip(), ())
+    name, *rest = body.split(None, 1)
+    return (indent, name, split_args(rest[0]) if rest else ())
+
+
+def split_lines(conf: str) -> list:
+    """Split a config text into lines as the editors read them"""
+    # str.splitlines also splits on \r, \f, \u2028 and so on
+    return io.StringIO(conf).readlines()
+
+
+def parse_conf(conf: str) -> tuple:
+    """Parse a config text into a line table and a name index"""
+    lines = []
+    names = {}
+    for lineno, line in enumerate(split_lines(conf)):
+        parsed = parse_line(line)
+        lines.append(parsed)
+        if parsed[1]:
+            names.setdefault(parsed[1], []).append(lineno)
+    return (tuple(lines), names)
+
+
+##
+# Cache
+##
+CACHE_VERSION = 1
+CACHE_ENTRIES = 256
+
+
+def cache_dir() -> str:
+    """Get the cache directory, or an empty string if the cache is disabled"""
+    setting = os.environ.get('HTCONF_CACHE', '')
+    if setting in ('', '0'):
+        return ''
+    if setting != '1':
+        return setting
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(
+        os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'htconf')
+
+
+def cache_key(file_path: str) -> tuple:
+    """Get the cache key of the file"""
+    stat = os.stat(file_path)
+    return (os.path.realpath(file_path), stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+
+def cache_path(directory: str, key: tuple) -> str:
+    """Get the path of the cache file for the key"""
+    import hashlib
+    return os.path.join(directory, hashlib.sha1(key[0].encode()).hexdigest() + '.idx')
+
+
+def cache_version() -> tuple:
+    """Get the version of the cache format, which depends on the marshal format"""
+    import marshal
+    return (CACHE_VERSION, marshal.version, sys.version_info[0], sys.version_info[1])
+
+
+def valid_parsed(parsed) -> bool:
+    """Whether the cached data has the structure of a parsed config"""
+    if not (isinstance(parsed, tuple) and len(parsed) == 2):
+        return False
+    lines, names = parsed
+    if not (isinstance(lines, tuple) and isinstance(names, dict)):
+        return False
+    for line in lines:
+        if not (isinstance(line, tuple) and len(line) == 3 and isinstance(line[0], str)
+                and isinstance(line[1], str) and isinstance(line[2], tuple)
+                and all(isinstance(arg, str) for arg in line[2])):
+            return False
+    for name, linenos in names.items():
+        if not (isinstance(name, str) and isinstance(linenos, list)
+                and all(isinstance(lineno, int) and 0 <= lineno < len(lines)
+                        for lineno in linenos)):
+            return False
+    return True
+
+
+def load_cache(file_path: str):
+    """Load the parsed config of the file from the cache, or None"""
+    directory = cache_dir()
+    if not directory:
+        return None
+    try:
+        key = cache_key(file_path)
+    except OSError:
+        return None
+    path = cache_path(directory, key)
+    import marshal
+    try:
+        with open(path, 'rb') as cache_file:
+            data = marshal.load(cache_file)
+        if not (isinstance(data, tuple) and len(data) == 3 and valid_parsed(data[2])):
+            raise ValueError('Invalid structure')
+        version, cached_key, parsed = data
+    except FileNotFoundError:
+        return None
+    except (OSError, EOFError, ValueError, TypeError):
+        # Broken cache file
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        return None
+    if version != cache_version() or cached_key != key:
+        return None
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+    return parsed
+
+
+def store_cache(file_path: str, parsed: tuple):
+    """Store the parsed config of the file into the cache"""
+    directory = cache_dir()
+    if not directory:
+        return
+    import marshal
+    try:
+        os.makedirs(directory, exist_ok=True)
+        key = cache_key(file_path)
+        path = cache_path(directory, key)
+        tmp_path = f"{path}.{os.getpid()}-{os.urandom(4).hex()}.tmp"
+        with open(tmp_path, 'wb') as cache_file:
+            marshal.dump((cache_version(), key, parsed), cache_file)
+        os.replace(tmp_path, path)
+        evict_cache(directory)
+    except OSError:
+        pass
+
+
+def evict_cache(directory: str):
+    """Remove the least recently used cache files over CACHE_ENTRIES"""
+    with os.scandir(directory) as entries:
+        files = [entry for entry in entries if entry.name.endswith('.idx')]
+    if len(files) <= CACHE_ENTRIES:
+        return
+    files.sort(key=lambda entry: entry.stat().st_mtime_ns)
+    for entry in files[:len(files) - CACHE_ENTRIES]:
+        try:
+            os.remove(entry.path)
+        except OSError:
+            pass
+
+
+def load_conf(file_path: str) -> tuple:
+    """Load the parsed config of the file, using the cache if enabled"""
+    parsed = load_cache(file_path)
+    if parsed is None:
+        with open(file_path, 'r') as read_file:
+            parsed = parse_conf(read_file.read())
+        store_cache(file_path, parsed)
+    return parsed
+
+
+##
+# Diff
+##
+class Patch:
+    """Changes of the lines of a config as sorted [start, end, new_lines] hunks"""
+    lines: list
+    hunks: list
+
+    def __init__(self, lines: list = None, hunks: list = None):
+        self.lines = lines or []
+        self.hunks = hunks or []
+
+    def merge(self, changes: list):
+        """Compose the changes of the edited lines into the hunks"""
+        self.hunks = merge_changes(self.lines, self.hunks, changes)
+        # Drop the hunks restoring the original lines
+        self.hunks = [hunk for hunk in self.hunks if hunk[2] != self.lines[hunk[0]:hunk[1]]]
+
+    def format_diff(self, file_path: str = None, context: int = 3) -> str:
+        """Format the hunks as a unified diff"""
+        return format_diff(self.lines, self.hunks, file_path, context)
+
+
+def apply_editors(conf: str, editors: list, patch: Patch = None, file_path: str = None) -> str:
+    """Edit the config text with the editors in order
+
+    If patch is given, the changes of the editors are recorded into it.
+    The observers of the editors are told when all editors are applied.
+    """
+    observers = unique_observers(editors)
+    if patch is None and not observers:
+        for editor in editors:
+            conf = editor.edit_text(conf)
+        return conf
+    import time
+    start = time.perf_counter()
+    if patch is not None:
+        patch.lines = split_lines(conf)
+        patch.hunks = []
+    text = conf
+    count = 0
+    for editor in editors:
+        changes = []
+        text = editor.edit_text(text, changes)
+        count += len(changes)
+        if patch is not None:
+            patch.merge(changes)
+    stats = {'file': file_path, 'editors': len(editors), 'changes': count,
+             'changed': text != conf, 'time': time.perf_counter() - start}
+    for observer in observers:
+        observer.on_file_done(stats)
+    return text
+
+
+def unique_observers(editors: list) -> list:
+    """Get the observers of the editors, each once"""
+    return list({id(observer): observer
+                 for editor in editors for observer in editor.observers}.values())
+
+
+def merge_changes(lines: list, patch: list, changes: list) -> list:
+    """Compose the changes of the edited lines into the patch of the original lines
+
+    changes are sorted (start, end, new_lines) of the lines edited by patch.
+    Only the hunks next to the changes are visited.
+    """
+    patch = [list(hunk) for hunk in patch]
+    # The offset of the edited lines to the original lines before each hunk
+    shifts = [0]
+    for start, end, new_lines in patch:
+        shifts.append(shifts[-1] + len(new_lines) - (end - start))
+    merged = []
+    for start, end, new_lines in sorted(changes, reverse=True):
+        # Hunks after the change are done
+        while patch and patch[-1][0] + shifts[len(patch) - 1] > end:
+            merged.append(patch.pop())
+        # Hunks overlapping or next to the change are merged with it
+        touched = []
+        while patch and patch[-1][0] + shifts[len(patch) - 1] + len(patch[-1][2]) >= start:
+            touched.insert(0, patch.pop())
+        shift = shifts[len(patch)]
+        if not touched:
+            patch.append([start - shift, end - shift, list(new_lines)])
+            continue
+        shift_after = shift + sum(len(hunk[2]) - (hunk[1] - hunk[0]) for hunk in touched)
+        origin_start = min(start - shift, touched[0][0])
+        origin_end = max(end - shift_after, touched[-1][1])
+        edited = lines[origin_start:touched[0][0]]
+        for hunk, next_hunk in zip(touched, touched[1:] + [None]):
+            edited += hunk[2]
+            edited += lines[hunk[1]:next_hunk[0] if next_hunk else origin_end]
+        offset = origin_start + shift
+        patch.append([origin_start, origin_end,
+                      edited[:start - offset] + list(new_lines) + edited[end - offset:]])
+    return patch + merged[::-1]
+
+
+def format_range(start: int, length: int) -> str:
+    """Format a range of a unified diff hunk header"""
+    if length == 1:
+        return f"{start + 1}"
+    if not length:
+        return f"{start},0"
+    return f"{start + 1},{length}"
+
+
+def format_diff(lines: list, patch: list, file_path: str = None, context: int = 3) -> str:
+    """Format the patch of the lines as a unified diff"""
+    def diff_line(mark: str, line: str) -> str:
+        if line.endswith('\n'):
+            return mark + line
+        return mark + line + '\n\\ No newline at end of file\n'
+
+    if not patch:
+        return ''
+    name = file_path or '-'
+    output = [f"--- {name}\n", f"+++ {name}\n"]
+    # Group the hunks whose contexts overlap
+    groups = [[patch[0]]]
+    for hunk in patch[1:]:
+        if hunk[0] - groups[-1][-1][1] <= context * 2:
+            groups[-1].append(hunk)
+        else:
+            groups.append([hunk])
+    shift = 0
+    for group in groups:
+        start = max(group[0][0] - context, 0)
+        end = min(group[-1][1] + context, len(lines))
+        new_length = (end - start) + sum(len(hunk[2]) - (hunk[1] - hunk[0]) for hunk in group)
+        output.append(f"@@ -{format_range(start, end - start)} "
+                      f"+{format_range(start + shift, new_length)} @@\n")
+        position = start
+        for hunk in group:
+            output += [diff_line(' ', line) for line in lines[position:hunk[0]]]
+            output += [diff_line('-', line) for line in lines[hunk[0]:hunk[1]]]
+            output += [diff_line('+', line) for line in hunk[2]]
+            position = hunk[1]
+        output += [diff_line(' ', line) for line in lines[position:end]]
+        shift += new_length - (end - start)
+    return ''.join(output)
+
+
+##
+# Edit script
+##
+EDIT_SCRIPT_VERSION = 1
+
+
+def content_hash(conf: str) -> str:
+    """Get the hash guarding an edit script"""
+    import hashlib
+    return hashlib.sha256(conf.encode()).hexdigest()
+
+
+class EditScript:
+    """Hunks of the expressions against the config of a known hash"""
+    digest: str
+    hunks: list
+    expressions: list
+
+    def __init__(self, digest: str, hunks: list, expressions: list):
+        self.digest = digest
+        self.hunks = hunks
+        self.expressions = expressions
+        # The editors are used when the hash does not match
+        self.editors = [Editor(['htconf'] + argv) for argv in expressions]
+
+    @classmethod
+    def build(cls, conf: str, editors: list) -> 'EditScript':
+        """Record the changes of the editors to the config"""
+        patch = Patch()
+        apply_editors(conf, editors, patch)
+        return cls(content_hash(conf), patch.hunks, [editor.argv for editor in editors])
+
+    @classmethod
+    def loads(cls, text: str) -> 'EditScript':
+        """Load an edit script, raising ExpressionError if it is invalid"""
+        import json
+        try:
+            script = json.loads(text)
+            if script.get('version') != EDIT_SCRIPT_VERSION:
+                raise ValueError(f"Unsupported Version {script.get('version')}")
+            position = 0
+            for start, end, new_lines in script['hunks']:
+                if not (position <= start <= end and all(isinstance(line, str)
+                                                         for line in new_lines)):
+                    raise ValueError(f"Invalid Hunk {start},{end}")
+                position = end
+            return cls(script['sha256'], script['hunks'], script['expressions'])
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            raise ExpressionError(f"Invalid Edit Script ({e})")
+
+    def dumps(self) -> str:
+        import json
+        return json.dumps({'version': EDIT_SCRIPT_VERSION, 'sha256': self.digest,
+                           'hunks': self.hunks, 'expressions': self.expressions},
+                          separators=(',', ':'))
+
+    def apply(self, conf: str, patch: Patch = None) -> str:
+        """Splice the hunks into the config of the hash, or run the expressions"""
+        if content_hash(conf) != self.digest:
+            return apply_editors(conf, self.editors, patch)
+        lines = split_lines(conf)
+        if patch is not None:
+            patch.lines = lines
+            patch.hunks = [list(hunk) for hunk in self.hunks]
+        output = []
+        position = 0
+        for start, end, new_lines in self.hunks:
+            output += lines[position:start]
+            output += new_lines
+            position = end
+        output += lines[position:]
+        return ''.join(output)
+
+
+##
+# Locking
+##
+def queue_dir(file_path: str) -> str:
+    """Get the directory of the edit jobs waiting for the lock of the file"""
+    import hashlib
+    import stat
+    import tempfile
+    parent = os.path.join(tempfile.gettempdir(), f"htconf-{os.getuid()}")
+    try:
+        os.mkdir(parent, 0o700)
+    except FileExistsError:
+        pass
+    # Jobs are only shared between the processes of the same user
+    info = os.lstat(parent)
+    if info.st_uid != os.getuid() or info.st_mode & 0o077 or not stat.S_ISDIR(info.st_mode):
+        raise PermissionError(f"Insecure queue directory ({parent})")
+    directory = os.path.join(
+        parent, hashlib.sha1(os.path.realpath(file_path).encode()).hexdigest())
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+
+def enqueue_job(directory: str, editors: list) -> tuple:
+    """Write the editors as a job waiting for the lock
+
+    Returns the path and the open job file. The job is only applied while
+    the file is open and locked, so closing it cancels the job.
+    """
+    import fcntl
+    import json
+    import time
+    path = os.path.join(directory, f"{time.time_ns():020d}-{os.getpid()}-{os.urandom(4).hex()}.job")
+    for attempt in range(3):
+        try:
+            job_file = open(path + '.tmp', 'w')
+            break
+        except FileNotFoundError:
+            # The directory has been removed by the last process leaving it
+            if attempt == 2:
+                raise
+            os.makedirs(directory, exist_ok=True)
+    try:
+        fcntl.flock(job_file, fcntl.LOCK_EX)
+        json.dump([editor.argv for editor in editors], job_file)
+        job_file.flush()
+        os.replace(path + '.tmp', path)
+    except BaseException:
+        job_file.close()
+        remove_file(path + '.tmp')
+        raise
+    return path, job_file
+
+
+def job_alive(path: str) -> bool:
+    """Whether the process of the job file still holds its lock"""
+    import fcntl
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return False
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return False
+    except BlockingIOError:
+        return True
+    finally:
+        os.close(fd)
+
+
+def remove_file(path: str):
+    """Remove the file if it exists"""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def claim_jobs(directory: str, job_path: str, editors: list) -> list:
+    """Claim the jobs of the processes waiting for the lock, in the order queued
+
+    Jobs are claimed by renaming them to .claimed, and only those whose
+    process still holds the lock of the job file are kept. The files left
+    by the processes that have exited are removed.
+    Returns (path, editors) of the jobs.
+    """
+    jobs = []
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if path == job_path:
+            jobs.append((path, editors))
+        elif name.endswith('.job'):
+            claimed = path + '.claimed'
+            try:
+                os.rename(path, claimed)
+            except FileNotFoundError:
+                # Cancelled
+                continue
+            if job_alive(claimed):
+                jobs.append((claimed, load_job(claimed)))
+            else:
+                remove_file(claimed)
+        elif name.endswith(('.claimed', '.changed', '.unchanged')) and not job_alive(path):
+            remove_file(path)
+    return jobs
+
+
+def load_job(path: str) -> list:
+    """Read the editors of a job, or an empty list if it is broken"""
+    import json
+    try:
+        with open(path, 'r') as job_file:
+            return [Editor(['htconf'] + argv) for argv in json.load(job_file)]
+    except (OSError, ValueError, TypeError):
+        return []
+
+
+def edit_file(file_path: str, editors: list, dry_run: bool = False, patch: Patch = None,
+              script: EditScript = None) -> bool:
+    """Edit the file with the editors, skipping unchanged files
+
+    The file is locked while it is rewritten. Only when the lock is held by
+    another process, the editors are queued as a job, and jobs queued by
+    other processes waiting for the lock are applied in the same pass, in
+    the order queued.
+    Returns whether the file has been rewritten, or would be with dry_run.
+    If patch is given, the changes are recorded into it, and the editors are
+    applied alone so that it holds only their changes. If script is given,
+    an EditScript or an Importer, editors are its equivalent editors and
+    script.apply is used when no other job is applied in the same pass.
+    """
+    parsed = load_cache(file_path)
+    if parsed is not None and not any(editor.touches(parsed) for editor in editors):
+        for observer in unique_observers(editors):
+            observer.on_file_done({'file': file_path, 'editors': len(editors), 'changes': 0,
+                                   'changed': False, 'time': 0.0})
+        return False
+    if dry_run:
+        with open(file_path, 'r') as read_file:
+            conf = read_file.read()
+        if script is not None:
+            return script.apply(conf, patch) != conf
+        return apply_editors(conf, editors, patch, file_path) != conf
+    try:
+        import fcntl
+    except ImportError:
+        fcntl = None
+
+    with open(file_path, 'r+') as conf_file:
+        if fcntl is None or patch is not None:
+            # Queued jobs are left to the next process not to record them
+            if fcntl is not None:
+                fcntl.flock(conf_file, fcntl.LOCK_EX)
+            return write_jobs(conf_file, file_path, None, [(None, editors)], patch, script)
+        try:
+            fcntl.flock(conf_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            locked = True
+        except BlockingIOError:
+            locked = False
+        if locked:
+            # Nobody holds the lock, so no job is waiting for it
+            return write_jobs(conf_file, file_path, None, [(None, editors)], patch, script)
+        directory = queue_dir(file_path)
+        job_path, job_file = enqueue_job(directory, editors)
+        try:
+            fcntl.flock(conf_file, fcntl.LOCK_EX)
+            if os.path.exists(job_path):
+                jobs = claim_jobs(directory, job_path, editors)
+                return write_jobs(conf_file, file_path, job_path, jobs, patch, script)
+            # Another process has applied the job while waiting for the lock
+            if os.path.exists(job_path + '.changed'):
+                return True
+            if os.path.exists(job_path + '.unchanged'):
+                return False
+            raise OSError(f"Unknown Result (the process applying the edit exited: {file_path})")
+        finally:
+            for path in (job_path, job_path + '.claimed',
+                         job_path + '.changed', job_path + '.unchanged'):
+                remove_file(path)
+            job_file.close()
+            try:
+                os.rmdir(directory)
+            except OSError:
+                # Other jobs are waiting
+                pass
+
+
+def write_jobs(conf_file, file_path: str, job_path: str, jobs: list,
+               patch: Patch = None, script: EditScript = None) -> bool:
+    """Apply the jobs to the locked file, leaving the results to their processes"""
+    conf = conf_file.read()
+    if script is not None and len(jobs) == 1:
+        text = script.apply(conf, patch)
+    else:
+        text = apply_editors(conf, [editor for _, job_editors in jobs
+                                    for editor in job_editors], patch, file_path)
+    changed = text != conf
+    if changed:
+        conf_file.seek(0)
+        conf_file.truncate()
+        conf_file.write(text)
+        conf_file.flush()
+    if cache_dir():
+        store_cache(file_path, parse_conf(text))
+    for path, _ in jobs:
+        if path and path != job_path:
+            try:
+                os.replace(path, path[:-len('.claimed')] + ('.changed' if changed else '.unchanged'))
+            except FileNotFoundError:
+                # Cancelled after being claimed
+                pass
+    return changed
+
+
+def edit_files(file_paths: list, editors: list, dry_run: bool = False, workers: int = 0) -> list:
+    """Edit the files on a thread pool, returning whether each has been rewritten
+
+    Editing the same file from several threads is serialized by its lock.
+    """
+    from concurrent import futures
+    editors = tuple(editors)
+    with futures.ThreadPoolExecutor(max_workers=workers or None) as executor:
+        return list(executor.map(lambda file_path: edit_file(file_path, editors, dry_run),
+                                 file_paths))
+
+
+class ExpressionError(ValueError):
+    """Invalid expression"""
+
+
+class Observer:
+    """Hooks called while editing, override the ones to use
+
+    Line numbers start at 1. Sections are those of the -s option.
+    """
+
+    def on_match(self, editor: 'Editor', lineno: int, old: str, new: str):
+        """A matched line is rewritten, or new lines are inserted with old None"""
+
+    def on_section_enter(self, editor: 'Editor', lineno: int, line: str):
+        """The matching section starts"""
+
+    def on_section_exit(self, editor: 'Editor', lineno: int, line: str):
+        """The matching section ends"""
+
+    def on_file_done(self, stats: dict):
+        """All editors are applied to a config"""
+
+
+class Editor:
+    operation: str = ''
+    directive: str = ''
+    values: str = ''
+    with_values: tuple = ()
+    with_section: str = ''
+    section_name: str = ''
+    section_value: str = ''
+    section_start: str = ''
+    section_end: str = ''
+    match: str = 'exact'
+    file_path: str = ''
+    dry_run: bool = False
+    diff: bool = False
+    script: bool = False
+    ignore_case: bool = False
+    observers: tuple = ()
+    frozen: bool = False
+
+    def __init__(self, argv):
+        if len(argv) < 3:
+            raise ExpressionError(f"Missing Arguments ({' '.join(argv[1:])})")
+        # Assign option value to variable
+        options, others = self.parse_options(argv[3:], 'f:', ['file=', 'dry-run', 'diff', 'script'])
+        for opt, optarg in others:
+            if opt in ('-f', '--file'):
+                self.file_path = optarg
+            elif opt == '--dry-run':
+                self.dry_run = True
+            elif opt == '--diff':
+                self.diff = True
+            elif opt == '--script':
+                self.script = True
+        self.build(argv[1], argv[2], options['values'], options['where'], options['section'],
+                   options['match'], options['ignore_case'])
+
+    @staticmethod
+    def parse_options(args: list, shortopts: str = '', longopts: list = ()) -> tuple:
+        """Parse the -v, -w, -s, --match and -i options of an expression
+
+        Returns the keyword arguments of compile, and the other options given
+        by shortopts and longopts as (opt, optarg).
+        """
+        import getopt
+        try:
+            options, _ = getopt.getopt(args, 'v:w:s:i' + shortopts,
+                                       ['value=', 'with=', 'section=', 'match=', 'ignore-case']
+                                       + list(longopts))
+        except getopt.GetoptError as e:
+            raise ExpressionError(f"Invalid Option ({e})")
+        kwargs = {'values': [], 'where': [], 'section': '', 'match': 'exact', 'ignore_case': False}
+        others = []
+        for opt, optarg in options:
+            if opt in ('-v', '--value'):
+                kwargs['values'].append(optarg)
+            elif opt in ('-w', '--with'):
+                kwargs['where'].append(optarg)
+            elif opt in ('-s', '--section'):
+                kwargs['section'] = optarg
+            elif opt == '--match':
+                kwargs['match'] = optarg
+            elif opt in ('-i', '--ignore-case'):
+                kwargs['ignore_case'] = True
+            else:
+                others.append((opt, optarg))
+        return kwargs, others
+
+    @classmethod
+    def compile(cls, op: str, directive: str, values: list = (), where: list = (),
+                section: str = '', match: str = 'exact', ignore_case: bool = False) -> 'Editor':
+        """Compile an immutable editor from keyword arguments
+
+        This is the same as the expression "op directive -v VALUE ... -w WHERE ...
+        -s SECTION --match=MATCH [-i]", and raises ExpressionError if it is invalid.
+        """
+        for name, value in (('op', op), ('directive', directive), ('section', section),
+                            ('match', match)):
+            if not isinstance(value, str):
+                raise ExpressionError(f"Invalid Argument ({name} must be a string: {value!r})")
+        lists = []
+        for name, value in (('values', values), ('where', where)):
+            try:
+                items = None if isinstance(value, str) else list(value)
+            except TypeError:
+                items = None
+            if items is None or not all(isinstance(item, str) for item in items):
+                raise ExpressionError(f"Invalid Argument ({name} must be a list of strings: {value!r})")
+            lists.append(items)
+        values, where = lists
+        editor = cls.__new__(cls)
+        editor.build(op, directive, values, where, section, match, ignore_case)
+        return editor
+
+    def build(self, operation: str, directive: str, values: list, with_values: list,
+              section: str, match: str, ignore_case: bool = False):
+        """Compile the expression and make the editor immutable"""
+        self.operation = operation
+        self.directive = directive
+        self.values = ''.join(' ' + esc_conf(value) for value in values)
+        self.with_values = tuple(with_values)
+        self.with_section = section
+        self.match = match
+        self.ignore_case = ignore_case
+        # The arguments to construct the same editor
+        self.argv = [operation, directive] + \
+            [arg for value in values for arg in ('-v', value)] + \
+            [arg for value in with_values for arg in ('-w', value)] + \
+            (['-s', section] if section else []) + \
+            ([f"--match={match}"] if match != 'exact' else []) + \
+            (['-i'] if ignore_case else [])
+
+        # Compile the value patterns once for the match mode
+        if not self.match in MATCH_MODES:
+            raise ExpressionError(f"Unknown Match Mode ({self.match})")
+        try:
+            self.value_patterns = tuple(compile_value(value, self.match)
+                                        for value in self.with_values)
+            # Split the with_section variable into the section name and value
+            if ':' in self.with_section:
+                self.section_name, self.section_value = self.with_section.split(':', 1)
+                self.section_patterns = (compile_value(self.section_value, self.match),)
+            else:
+                self.section_name = self.with_section
+                self.section_patterns = ()
+        except re.error as e:
+            raise ExpressionError(f"Invalid Pattern ({e.pattern}: {e})")
+        self.section_start = self.name_key('<' + self.section_name)
+        self.section_end = self.name_key('</' + self.section_name)
+
+        # Construct the name of the function to execute
+        if not self.operation in ('add', 'set', 'enable', 'disable'):
+            raise ExpressionError(f"Unknown Operation ({self.operation})")
+        self.func = self.operation
+        match = re.match(r'<(\w+)>', self.directive)
+        if match:
+            if self.operation != "set":
+                raise ExpressionError(f"Unsupported Operation ({self.operation} {self.directive})")
+
+            self.directive = match.group(1)
+            self.func += '_section'
+            self.match_name = '<' + self.directive
+        else:
+            self.func += '_directive'
+            self.match_name = ('#' if self.operation == 'enable' else '') + self.directive
+
+        if self.with_section:
+            self.func += '_with_section'
+        self.match_key = self.name_key(self.match_name)
+        self.frozen = True
+
+    def __setattr__(self, name, value):
+        if self.frozen:
+            raise AttributeError(f"Editor is immutable ({name})")
+        super().__setattr__(name, value)
+
+    def observe(self, observer: Observer) -> 'Editor':
+        """Get a copy of the editor calling the hooks of the observer"""
+        editor = self.__class__.__new__(self.__class__)
+        editor.__dict__.update(self.__dict__)
+        editor.__dict__['observers'] = self.observers + (observer,)
+        return editor
+
+    def match_values(self, args: tuple, patterns: tuple = None) -> bool:
+        """Whether the leading arguments match the values"""
+        if patterns is None:
+            patterns = self.value_patterns
+        if len(args) < len(patterns):
+            return False
+        if self.match == 'exact':
+            return args[:len(patterns)] == patterns
+        if self.match == 'prefix':
+            return all(arg.startswith(pattern) for arg, pattern in zip(args, patterns))
+        return all(pattern.fullmatch(arg) for arg, pattern in zip(args, patterns))
+
+    def match_line(self, parsed: tuple) -> bool:
+        """Whether the parsed line is the directive to edit"""
+        name = parsed[1].casefold() if self.ignore_case else parsed[1]
+        return name == self.match_key and self.match_values(parsed[2])
+
+    def name_key(self, name: str) -> str:
+        """Get the key to compare the name, casefolded if ignoring case"""
+        return name.casefold() if self.ignore_case else name
+
+    def original_name(self, parsed: tuple) -> str:
+        """Get the directive name of the matched line as written in the file"""
+        return parsed[1][len(self.match_name) - len(self.directive):]
+
+    def iter_lines(self, instream: io.TextIOWrapper):
+        """Yield (lineno, line, parsed, section_indent) for each line
+
+        section_indent is the indent of the matching section the line is in,
+        or None outside of it. It is always '' without -s.
+        """
+        if not self.with_section:
+            for lineno, line in enumerate(instream):
+                yield lineno, line, parse_line(line), ''
+            return
+        section_indent = None
+        for lineno, line in enumerate(instream):
+            parsed = parse_line(line)
+            event = self.section_event(parsed, section_indent)
+            if event == 'enter':
+                section_indent = parsed[0]
+                for observer in self.observers:
+                    observer.on_section_enter(self, lineno + 1, line)
+            elif event == 'exit':
+                section_indent = None
+                for observer in self.observers:
+                    observer.on_section_exit(self, lineno + 1, line)
+            yield lineno, line, parsed, section_indent
+
+    def section_event(self, parsed: tuple, section_indent: str = None) -> str:
+        """Get 'enter' if the parsed line starts the matching section, 'exit' if it
+        ends the section entered at section_indent, or '' otherwise"""
+        name = parsed[1].casefold() if self.ignore_case else parsed[1]
+        if name == self.section_start and self.match_values(parsed[2], self.section_patterns):
+            return 'enter'
+        if section_indent is not None and name == self.section_end and parsed[0] == section_indent:
+            return 'exit'
+        return ''
+
+    def replace_line(self, outstream: io.TextIOWrapper, changes: list, lineno: int, line: str, new_line: str):
+        """Write the rewritten line, recording the change"""
+        print(new_line, end='', file=outstream)
+        if changes is not None and new_line != line:
+            changes.append((lineno, lineno + 1, [new_line]))
+        for observer in self.observers:
+            observer.on_match(self, lineno + 1, line, new_line)
+
+    def insert_lines(self, outstream: io.TextIOWrapper, changes: list, lineno: int, new_lines: list,
+                     last_line: str = ''):
+        """Write the new lines before the line, recording the change
+
+        last_line is the line before them, ended first if it has no newline.
+        """
+        if last_line and not last_line.endswith('\n'):
+            print('', file=outstream)
+            if changes is not None:
+                changes.append((lineno - 1, lineno, [last_line + '\n'] + new_lines))
+        elif changes is not None:
+            changes.append((lineno, lineno, new_lines))
+        print(''.join(new_lines), end='', file=outstream)
+        for observer in self.observers:
+            observer.on_match(self, lineno + 1, None, ''.join(new_lines))
+
+    def add_directive(self, instream: io.TextIOWrapper, outstream: io.TextIOWrapper, changes: list = None):
+        """Add the directive at the end of file"""
+        lineno = 0
+        line = ''
+        for lineno, line in enumerate(instream, 1):
+            print(line, end='', file=outstream)
+        self.insert_lines(outstream, changes, lineno,
+                          [f"{self.directive}{self.values}\n"], line)
+
+    def add_directive_with_section(self, instream: io.TextIOWrapper, outstream: io.TextIOWrapper, changes: list = None):
+        """Add the directive at the end of the section"""
+        indent = None
+        not_added = True
+        lineno = -1
+        line = ''
+        for lineno, line, _, section_indent in self.iter_lines(instream):
+            # The end of the section closes it
+            if indent is not None and section_indent is None:
+                self.insert_lines(outstream, changes, lineno,
+                                  [f"{indent}    {self.directive}{self.values}\n"])
+                not_added = False
+            indent = section_indent
+            print(line, end='', file=outstream)
+
+        if not_added:
+            self.insert_lines(outstream, changes, lineno + 1, [
+                f"<{self.section_name} {self.section_value}>\n",
+                f"    {self.directive}{self.values}\n",
+                f"</{self.section_name}>\n",
+            ], line)
+
+    def set_directive(self, instream: io.TextIOWrapper, outstream: io.TextIOWrapper, changes: list = None):
+        """Set the values of the directive"""
+        for lineno, line, parsed, section_indent in self.iter_lines(instream):
+            if section_indent is not None and self.match_line(parsed):
+                self.replace_line(outstream, changes, lineno, line,
+                                  f"{parsed[0]}{self.original_name(parsed)}{self.values}\n")
+            else:
+                print(line, end='', file=outstream)
+
+    def set_directive_with_section(self, instream: io.TextIOWrapper, outstream: io.TextIOWrapper, changes: list = None):
+        """Set the values of the directive within the section"""
+        self.set_directive(instream, outstream, changes)
+
+    def set_section(self, instream: io.TextIOWrapper, outstream: io.TextIOWrapper, changes: list = None):
+        """Set the values of the section directive"""
+        for lineno, line, parsed, section_indent in self.iter_lines(instream):
+            if section_indent is not None and self.match_line(parsed):
+                self.replace_line(outstream, changes, lineno, line,
+                                  f"{parsed[0]}<{self.original_name(parsed)}{self.values}>\n")
+            else:
+                print(line, end='', file=outstream)
+
+    def set_section_with_section(self, instream: io.TextIOWrapper, outstream: io.TextIOWrapper, changes: list = None):
+        """Set the values of the section directive within the section"""
+        self.set_section(instream, outstream, changes)
+
+    def disable_directive(self, instream: io.TextIOWrapper, outstream: io.TextIOWrapper, changes: list = None):
+        """Comment out the directive"""
+        for lineno, line, parsed, section_indent in self.iter_lines(instream):
+            if section_indent is not None and self.match_line(parsed):
+                self.replace_line(outstream, changes, lineno, line,
+                                  f"{parsed[0]}#{line[len(parsed[0]):]}")
+            else:
+                print(line, end='', file=outstream)
+
+    def disable_directive_with_section(self, instream: io.TextIOWrapper, outstream: io.TextIOWrapper, changes: list = None):
+        """Comment out the directive inside the section"""
+        self.disable_directive(instream, outstream, changes)
+
+    def enable_directive(self, instream: io.TextIOWrapper, outstream: io.TextIOWrapper, changes: list = None):
+        """Enable the directive and set its values"""
+        for lineno, line, parsed, section_indent in self.iter_lines(instream):
+            if section_indent is not None and self.match_line(parsed):
+                if self.values:
+                    new_line = f"{parsed[0]}{self.original_name(parsed)}{self.values}\n"
+                else:
+                    new_line = f"{parsed[0]}{line[len(parsed[0]) + 1:]}"
+                self.replace_line(outstream, changes, lineno, line, new_line)
+            else:
+                print(line, end='', file=outstream)
+
+    def enable_directive_with_section(self, instream: io.TextIOWrapper, outstream: io.TextIOWrapper, changes: list = None):
+        """Enables the directive within the section and set its values"""
+        self.enable_directive(instream, outstream, changes)
+
+    def touches(self, parsed: tuple) -> bool:
+        """Whether the editor may change a config with the parsed line table"""
+        if self.operation == 'add':
+            return True
+        lines, names = parsed
+        if self.ignore_case:
+            linenos = [lineno for name, name_linenos in names.items()
+                       if name.casefold() == self.match_key for lineno in name_linenos]
+        else:
+            linenos = names.get(self.match_name, ())
+        return any(self.match_line(lines[lineno]) for lineno in linenos)
+
+    def edit(self):
+        if self.file_path:
+            self.edit_file(self.file_path)
+        else:
+            self.edit_stream(sys.stdin, sys.stdout)
+
+    def edit_file(self, file_path) -> bool:
+        return edit_file(file_path, [self], self.dry_run)
+
+    def edit_text(self, conf: str, changes: list = None) -> str:
+        with io.StringIO() as outstream:
+            self.edit_stream(io.StringIO(conf), outstream, changes)
+            return outstream.getvalue()
+
+    def edit_stream(self, instream: io.TextIOWrapper, outstream: io.TextIOWrapper, changes: list = None):
+        self.FUNCTIONS[self.func](self, instream, outstream, changes)
+
+    # Edit functions by the name constructed from the operation
+    FUNCTIONS = {
+        'add_directive': add_directive,
+        'add_directive_with_section': add_directive_with_section,
+        'set_directive': set_directive,
+        'set_directive_with_section': set_directive_with_section,
+        'set_section': set_section,
+        'set_section_with_section': set_section_with_section,
+        'disable_directive': disable_directive,
+        'disable_directive_with_section': disable_directive_with_section,
+        'enable_directive': enable_directive,
+        'enable_directive_with_section': enable_directive_with_section,
+    }
+
+
+class Expressions:
+    """Editors applied in order
+
+    The editors and observers are tuples replaced as a whole, so edits
+    running in other threads keep the editors they started with. Adding
+    editors and observers is serialized by a lock.
+    """
+    editors: tuple
+    observers: tuple
+
+    def __init__(self, editors: list = ()):
+        import threading
+        self.editors = tuple(editors)
+        self.observers = ()
+        self.lock = threading.Lock()
+
+    def add(self, editor: Editor):
+        with self.lock:
+            for observer in self.observers:
+                editor = editor.observe(observer)
+            self.editors += (editor,)
+
+    def observe(self, observer: Observer):
+        """Call the hooks of the observer from all editors"""
+        with self.lock:
+            self.observers += (observer,)
+            self.editors = tuple(editor.observe(observer) for editor in self.editors)
+
+    def edit_file(self, file_path: str, dry_run: bool = False) -> bool:
+        return edit_file(file_path, self.editors, dry_run)
+
+    def edit_files(self, file_paths: list, dry_run: bool = False, workers: int = 0) -> list:
+        return edit_files(file_paths, self.editors, dry_run, workers)
+
+    def edit_text(self, conf: str, patch: Patch = None) -> str:
+        return apply_editors(conf, self.editors, patch)
+
+    def edit_stream(self, instream: io.TextIOWrapper, outstream: io.TextIOWrapper):
+        outstream.write(apply_editors(instream.read(), self.editors))
+
+
+##
+# Batch
+##
+EXPRESSION_CACHE = {}
+EXPRESSION_CACHE_SIZE = 1024
+
+
+def compile_expression(expression: str) -> Editor:
+    """Compile an expression string, reusing the editors compiled before"""
+    editor = EXPRESSION_CACHE.get(expression)
+    if editor is None:
+        import shlex
+        editor = Editor(['htconf'] + shlex.split(expression))
+        if len(EXPRESSION_CACHE) >= EXPRESSION_CACHE_SIZE:
+            EXPRESSION_CACHE.clear()
+        EXPRESSION_CACHE[expression] = editor
+    return editor
+
+
+def run_job(job: dict) -> dict:
+    """Run a batch job and return its result"""
+    import time
+    start = time.perf_counter()
+    result = {'id': job.get('id'), 'status': 'ok'}
+    try:
+        for key in ('file', 'text'):
+            if key in job and not isinstance(job[key], str):
+                raise ExpressionError(f"Invalid Job ({key} must be a string)")
+        expressions = job['expressions']
+        if not isinstance(expressions, list) or not all(isinstance(expression, str)
+                                                        for expression in expressions):
+            raise ExpressionError("Invalid Job (expressions must be a list of strings)")
+        editors = [compile_expression(expression) for expression in expressions]
+        if 'file' in job:
+            result['changed'] = edit_file(job['file'], editors)
+            if job.get('output'):
+                with open(job['file'], 'r') as read_file:
+                    result['output'] = read_file.read()
+        else:
+            text = apply_editors(job['text'], editors)
+            result['changed'] = text != job['text']
+            result['output'] = text
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        result['status'] = 'error'
+        result['error'] = f"{type(e).__name__}: {e}"
+    result['time'] = time.perf_counter() - start
+    return result
+
+
+def map_chunk(function, chunk: list) -> list:
+    """Map the function over a chunk of items in a worker process"""
+    return [function(item) for item in chunk]
+
+
+def map_processes(function, items, workers: int = 0, chunksize: int = 1, ordered: bool = True):
+    """Yield the results of the function over the items from a pool of worker processes
+
+    workers is the number of CPUs by default, and a single worker maps in
+    this process. A bounded number of chunks is in flight, and the results
+    are yielded as they finish unless ordered.
+    """
+    workers = workers or os.cpu_count() or 1
+    if workers == 1:
+        yield from map(function, items)
+        return
+    import itertools
+    from concurrent import futures
+    items = iter(items)
+    with futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = []
+        for chunk in iter(lambda: list(itertools.islice(items, chunksize)), []):
+            pending.append(executor.submit(map_chunk, function, chunk))
+            # Keep a bounded number of chunks in flight
+            if len(pending) < workers * 4:
+                continue
+            if ordered:
+                yield from pending.pop(0).result()
+            else:
+                done, not_done = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+                pending = list(not_done)
+                for future in done:
+                    yield from future.result()
+        for future in pending if ordered else futures.as_completed(pending):
+            yield from future.result()
+
+
+def batch(instream: io.TextIOWrapper, outstream: io.TextIOWrapper, workers: int = 0):
+    """Run NDJSON jobs from instream, writing NDJSON results as they finish"""
+    import json
+
+    def write(result: dict):
+        print(json.dumps(result), file=outstream, flush=True)
+
+    def read_jobs():
+        for lineno, line in enumerate(instream, 1):
+            if not line.strip():
+                continue
+            try:
+                job = json.loads(line)
+                if not isinstance(job, dict):
+                    raise ValueError('Not an object')
+            except ValueError as e:
+                write({'id': None, 'status': 'error',
+                       'error': f"Invalid Job (line {lineno}: {e})", 'time': 0.0})
+                continue
+            yield job
+
+    for result in map_processes(run_job, read_jobs(), workers, ordered=False):
+        write(result)
+
+
+##
+# Dump
+##
+def iter_records(lines, file_path: str = None):
+    """Yield the sections and directives of parsed lines as records"""
+    sections = []
+    for lineno, (_, name, args) in enumerate(lines, 1):
+        if not name or name[0] == '#':
+            continue
+        if name[:2] == '</':
+            # Close the innermost section of the name, ignoring unbalanced ends
+            for depth in range(len(sections) - 1, -1, -1):
+                if sections[depth][0] == name[2:]:
+                    del sections[depth:]
+                    break
+            continue
+        record = {
+            'type': 'section' if name[0] == '<' else 'directive',
+            'name': name.lstrip('<'),
+            'args': list(args),
+            'section': [list(section) for section in sections],
+            'file': file_path,
+            'line': lineno,
+        }
+        yield record
+        if name[0] == '<':
+            sections.append((record['name'],) + tuple(args))
+
+
+def iter_file_lines(file_path: str):
+    """Yield the parsed lines of the file, from the cache if possible"""
+    parsed = load_cache(file_path)
+    if parsed is not None:
+        yield from parsed[0]
+        return
+    with open(file_path, 'r') as read_file:
+        yield from map(parse_line, read_file)
+
+
+def dump(sources: list, outstream, output_format: str = 'json'):
+    """Write the records of the sources and an index of their locations"""
+    if output_format == 'msgpack':
+        import msgpack
+        packer = msgpack.Packer()
+        stream = getattr(outstream, 'buffer', outstream)
+
+        def write(record: dict):
+            stream.write(packer.pack(record))
+    else:
+        import json
+
+        def write(record: dict):
+            print(json.dumps(record), file=outstream)
+
+    index = {}
+    for file_path, lines in sources:
+        for record in iter_records(lines, file_path):
+            write(record)
+            key = ('<' if record['type'] == 'section' else '') + record['name']
+            index.setdefault(key, []).append([file_path, record['line']])
+    write({'type': 'index', 'index': index})
+
+
+##
+# Drift
+##
+# A host is an outlier when its drift exceeds the median by this many MADs
+DRIFT_OUTLIER = 3.0
+
+
+def host_settings(file_path: str) -> tuple:
+    """Return the file and its sorted (section path, name, args) settings"""
+    try:
+        settings = {(tuple(map(tuple, record['section'])),
+                     ('<' if record['type'] == 'section' else '') + record['name'],
+                     tuple(record['args']))
+                    for record in iter_records(iter_file_lines(file_path))}
+    except (OSError, UnicodeDecodeError) as e:
+        return file_path, None, f"{type(e).__name__}: {e}"
+    return file_path, sorted(settings), None
+
+
+def drift(file_paths, outstream, workers: int = 0, threshold: float = 0.5):
+    """Write NDJSON records of the settings drifting from the fleet baseline
+
+    Each host is a row and each distinct setting a column of a binary matrix,
+    sparse if SciPy is available. Settings on at least threshold of the hosts
+    make the baseline.
+    """
+    import json
+    import numpy
+    try:
+        from scipy import sparse
+    except ImportError:
+        sparse = None
+
+    def write(record: dict):
+        print(json.dumps(record), file=outstream)
+
+    hosts = []
+    columns = {}
+    indices = []
+    indptr = [0]
+    for file_path, settings, error in map_processes(host_settings, file_paths, workers, chunksize=16):
+        if error:
+            write({'type': 'error', 'file': file_path, 'error': error})
+            continue
+        hosts.append(file_path)
+        indices.extend(columns.setdefault(setting, len(columns)) for setting in settings)
+        indptr.append(len(indices))
+    if not hosts:
+        return
+
+    shape = (len(hosts), len(columns))
+    indices = numpy.array(indices, dtype=numpy.int64)
+    indptr = numpy.array(indptr, dtype=numpy.int64)
+    if sparse:
+        matrix = sparse.csr_matrix((numpy.ones(len(indices), dtype=numpy.int64),
+                                    indices, indptr), shape=shape)
+    else:
+        matrix = numpy.zeros(shape, dtype=numpy.int64)
+        matrix[numpy.repeat(numpy.arange(shape[0]), numpy.diff(indptr)), indices] = 1
+
+    counts = numpy.asarray(matrix.sum(axis=0)).ravel()
+    frequency = counts / shape[0]
+    baseline = frequency >= threshold
+    shared = numpy.asarray(matrix @ baseline.astype(numpy.int64)).ravel()
+    sizes = numpy.diff(indptr)
+    missing = baseline.sum() - shared
+    extra = sizes - shared
+    drifts = missing + extra
+    median = numpy.median(drifts)
+    mad = numpy.median(numpy.abs(drifts - median))
+    outliers = drifts > median + DRIFT_OUTLIER * max(mad, 1.0)
+
+    # Identical rows get identical random projections; the chance of two
+    # different rows colliding on 128 bits is negligible
+    weights = numpy.random.default_rng(0).integers(
+        0, numpy.iinfo(numpy.uint64).max, size=(shape[1], 2), dtype=numpy.uint64, endpoint=True)
+    signatures = numpy.asarray(matrix.astype(numpy.uint64) @ weights)
+    _, inverse, cluster_sizes = numpy.unique(signatures, axis=0,
+                                             return_inverse=True, return_counts=True)
+    # Number the clusters from the largest
+    order = numpy.argsort(-cluster_sizes, kind='stable')
+    rank = numpy.empty_like(order)
+    rank[order] = numpy.arange(len(order))
+    clusters = rank[inverse.ravel()]
+
+    settings = list(columns)
+    for column in numpy.argsort(-counts, kind='stable'):
+        section, name, args = settings[column]
+        write({'type': 'setting', 'id': int(column),
+               'section': [list(path) for path in section], 'name': name, 'args': list(args),
+               'hosts': int(counts[column]), 'frequency': float(frequency[column]),
+               'baseline': bool(baseline[column])})
+    baseline_ids = numpy.flatnonzero(baseline)
+    for host, file_path in enumerate(hosts):
+        row = indices[indptr[host]:indptr[host + 1]]
+        write({'type': 'host', 'file': file_path, 'drift': int(drifts[host]),
+               'missing': numpy.setdiff1d(baseline_ids, row, assume_unique=True).tolist(),
+               'extra': row[~baseline[row]].tolist(),
+               'outlier': bool(outliers[host]), 'cluster': int(clusters[host])})
+    members = numpy.argsort(clusters, kind='stable')
+    for cluster, group in enumerate(numpy.split(members, numpy.cumsum(cluster_sizes[order])[:-1])):
+        write({'type': 'cluster', 'cluster': cluster, 'hosts': len(group),
+               'files': [hosts[host] for host in group]})
+
+
+##
+# Check
+##
+# Exit status of check when an assertion fails
+EXIT_FAILED = 2
+
+
+class Assertion:
+    kind: str = ''
+    text: str = ''
+    lineno: int = 0
+    values: tuple = None
+
+    def __init__(self, argv: list, text: str = '', lineno: int = 0):
+        if len(argv) < 2:
+            raise ExpressionError(f"Missing Arguments ({' '.join(argv)})")
+        if not argv[0] in ('present', 'absent'):
+            raise ExpressionError(f"Unknown Assertion ({argv[0]})")
+        self.kind = argv[0]
+        self.text = text or ' '.join(argv)
+        self.lineno = lineno
+        options, _ = Editor.parse_options(argv[2:])
+        values = options.pop('values')
+        if values:
+            if self.kind == 'absent':
+                raise ExpressionError("Unsupported Option (absent -v)")
+            self.values = tuple(values)
+        # set and disable select the active directive or section the same way
+        self.editor = Editor.compile('set' if argv[1][:1] == '<' else 'disable', argv[1], **options)
+
+    def result(self, found: list, file_path: str = None) -> dict:
+        """Get the result of the assertion from the (lineno, args) found"""
+        if self.kind == 'absent':
+            passed = not found
+        else:
+            wrong = [(lineno, args) for lineno, args in found
+                     if self.values is not None and args != self.values]
+            passed = bool(found) and not wrong
+            found = wrong or found
+        return {'type': 'result', 'file': file_path, 'assertion': self.text, 'policy_line': self.lineno,
+                'status': 'pass' if passed else 'fail',
+                'lines': [lineno for lineno, _ in found]}
+
+
+class Policy:
+    def __init__(self, policy: str = ''):
+        self.assertions = []
+        # Assertion indices by the name, and by the casefolded name for -i
+        self.names = {}
+        self.folded_names = {}
+        # Editors tracking each distinct -s, and the index of that of each assertion
+        self.scopes = []
+        self.scope_indices = {}
+        self.assertion_scopes = []
+        for lineno, line in enumerate(policy.splitlines(), 1):
+            if line.strip() and not line.lstrip().startswith('#'):
+                self.add(line, lineno)
+
+    def add(self, line: str, lineno: int = 0):
+        """Add the assertion of the policy line"""
+        import shlex
+        try:
+            assertion = Assertion(shlex.split(line), line.strip(), lineno)
+        except (ExpressionError, ValueError) as e:
+            raise ExpressionError(f"Invalid Policy (line {lineno}: {e})")
+        editor = assertion.editor
+        names = self.folded_names if editor.ignore_case else self.names
+        names.setdefault(editor.match_key, []).append(len(self.assertions))
+        scope = None
+        if editor.with_section:
+            scope = self.scope_indices.setdefault((editor.with_section, editor.match, editor.ignore_case),
+                                                  len(self.scopes))
+            if scope == len(self.scopes):
+                self.scopes.append(editor)
+        self.assertions.append(assertion)
+        self.assertion_scopes.append(scope)
+
+    def check(self, lines, file_path: str = None) -> list:
+        """Evaluate all assertions in one pass over the parsed lines
+
+        Lines are matched and in the section of -s as the editors find them.
+        """
+        found = [[] for _ in self.assertions]
+        section_indents = [None] * len(self.scopes)
+        empty = []
+        for lineno, parsed in enumerate(lines, 1):
+            for scope, editor in enumerate(self.scopes):
+                event = editor.section_event(parsed, section_indents[scope])
+                if event == 'enter':
+                    section_indents[scope] = parsed[0]
+                elif event == 'exit':
+                    section_indents[scope] = None
+            name = parsed[1]
+            if not name:
+                continue
+            indices = self.names.get(name, empty)
+            if self.folded_names:
+                indices = indices + self.folded_names.get(name.casefold(), empty)
+            for index in indices:
+                scope = self.assertion_scopes[index]
+                if (scope is None or section_indents[scope] is not None) \
+                        and self.assertions[index].editor.match_line(parsed):
+                    found[index].append((lineno, parsed[2]))
+        return [assertion.result(lines_found, file_path)
+                for assertion, lines_found in zip(self.assertions, found)]
+
+
+def check_file(policy: Policy, file_path: str) -> list:
+    """Check the file against the policy without writing it"""
+    try:
+        return policy.check(iter_file_lines(file_path), file_path)
+    except (OSError, UnicodeDecodeError) as e:
+        return [{'type': 'error', 'file': file_path, 'error': f"{type(e).__name__}: {e}"}]
+
+
+def check(policy: Policy, file_paths: list, instream, outstream, workers: int = 0) -> int:
+    """Write NDJSON results of the policy for each file, returning the exit status"""
+    import json
+    import functools
+    summary = {'type': 'summary', 'files': 0, 'pass': 0, 'fail': 0, 'error': 0}
+    if not file_paths:
+        results = [policy.check(map(parse_line, instream))]
+    else:
+        results = map_processes(functools.partial(check_file, policy), file_paths,
+                                1 if len(file_paths) == 1 else workers, chunksize=16)
+    for file_results in results:
+        summary['files'] += 1
+        for result in file_results:
+            summary[result.get('status', 'error')] += 1
+            print(json.dumps(result), file=outstream)
+    print(json.dumps(summary), file=outstream)
+    if summary['error']:
+        return 1
+    return EXIT_FAILED if summary['fail'] else 0
+
+
+##
+# Import
+##
+IMPORT_FIELDS = ('section', 'directive', 'values')
+
+
+def read_rows(text: str, input_format: str = 'json') -> list:
+    """Read the rows of directives to import from JSON lines, a JSON array or CSV
+
+    Each row has a directive, its values as a list or a string of arguments,
+    and optionally a section as -s.
+    """
+    if input_format == 'csv':
+        import csv
+        reader = csv.DictReader(io.StringIO(text))
+        rows = [(reader.line_num, row) for row in reader]
+    elif text.lstrip().startswith('['):
+        import json
+        try:
+            rows = list(enumerate(json.loads(text), 1))
+        except ValueError as e:
+            raise ExpressionError(f"Invalid Rows ({e})")
+    else:
+        import json
+        rows = []
+        for lineno, line in enumerate(text.splitlines(), 1):
+            if line.strip():
+                try:
+                    rows.append((lineno, json.loads(line)))
+                except ValueError as e:
+                    raise ExpressionError(f"Invalid Row (line {lineno}: {e})")
+    result = []
+    for lineno, row in rows:
+        if not isinstance(row, dict) or not row.get('directive'):
+            raise ExpressionError(f"Invalid Row (line {lineno}: Missing directive)")
+        if not isinstance(row['directive'], str):
+            raise ExpressionError(f"Invalid Row (line {lineno}: Directive must be a string)")
+        if not isinstance(row.get('section') or '', str):
+            raise ExpressionError(f"Invalid Row (line {lineno}: Section must be a string)")
+        values = row.get('values') or ()
+        if isinstance(values, str):
+            values = split_args(values)
+        if not isinstance(values, (list, tuple)) or not all(isinstance(value, str) for value in values):
+            raise ExpressionError(f"Invalid Row (line {lineno}: Values must be strings)")
+        result.append({'section': row.get('section') or '', 'directive': row['directive'],
+                       'values': list(values)})
+    return result
+
+
+class Importer:
+    """Rows of directives added to their sections in one pass
+
+    The result is the same as adding each row with "add DIRECTIVE -v VALUE
+    ... -s SECTION" in order, and editors are those add editors.
+    """
+    editors: tuple
+
+    def __init__(self, rows: list):
+        editors = []
+        for row in rows:
+            if row['directive'][:1] == '<':
+                raise ExpressionError(f"Unsupported Operation (add {row['directive']})")
+            editors.append(Editor.compile('add', row['directive'], row['values'],
+                                          section=row['section']))
+        self.editors = tuple(editors)
+        # Rows by the -s value, and the -s values by the section name
+        self.targets = {}
+        self.sections = {}
+        for index, editor in enumerate(self.editors):
+            if editor.with_section:
+                if not editor.with_section in self.targets:
+                    self.sections.setdefault(editor.section_name, []).append(editor.with_section)
+                self.targets.setdefault(editor.with_section, []).append(index)
+
+    def apply(self, conf: str, patch: Patch = None) -> str:
+        """Insert all rows into the config in one pass"""
+        lines = split_lines(conf)
+        inserts = {}
+        found = set()
+        # The indents of the matching sections being read by the -s value,
+        # tracked as each add editor does
+        indents = {}
+        for lineno, line in enumerate(lines):
+            if not '<' in line:
+                continue
+            indent, name, args = parse_line(line)
+            if name[:2] == '</':
+                rows = []
+                for with_section in self.sections.get(name[2:], ()):
+                    if indents.get(with_section) == indent:
+                        del indents[with_section]
+                        rows += self.targets[with_section]
+                if rows:
+                    inserts[lineno] = [f"{indent}    {self.editors[index].directive}"
+                                       f"{self.editors[index].values}\n"
+                                       for index in sorted(rows)]
+            elif name[:1] == '<':
+                for with_section in self.sections.get(name[1:], ()):
+                    editor = self.editors[self.targets[with_section][0]]
+                    if editor.match_values(args, editor.section_patterns):
+                        found.add(with_section)
+                        indents[with_section] = indent
+
+        # Rows of the sections not found make new sections at the end of the
+        # config, and later rows go into the new sections they match
+        items = []
+        blocks = {}
+        for editor in self.editors:
+            line = f"{editor.directive}{editor.values}\n"
+            if not editor.with_section:
+                items.append(line)
+                continue
+            matched = [block for block in blocks.get(editor.section_name, ())
+                       if editor.match_values(block[0], editor.section_patterns)]
+            for block in matched:
+                block[1].append(f"    {line}")
+            if not matched and not editor.with_section in found:
+                block = (parse_line(f"<{editor.section_name} {editor.section_value}>")[2],
+                         [f"<{editor.section_name} {editor.section_value}>\n", f"    {line}"],
+                         editor.section_name)
+                blocks.setdefault(editor.section_name, []).append(block)
+                items.append(block)
+        end_lines = []
+        for item in items:
+            if isinstance(item, str):
+                end_lines.append(item)
+            else:
+                end_lines += item[1] + [f"</{item[2]}>\n"]
+        hunks = [[lineno, lineno, new_lines] for lineno, new_lines in sorted(inserts.items())]
+        if end_lines and lines and not lines[-1].endswith('\n'):
+            # The last line is ended first as the add editors do
+            hunks.append([len(lines) - 1, len(lines), [lines[-1] + '\n'] + end_lines])
+        elif end_lines:
+            hunks.append([len(lines), len(lines), end_lines])
+
+        if patch is not None:
+            patch.lines = lines
+            patch.hunks = hunks
+        output = []
+        position = 0
+        for start, end, new_lines in hunks:
+            output += lines[position:start]
+            output += new_lines
+            position = end
+        output += lines[position:]
+        return ''.join(output)
+
+
+def edit(editors: list, file_path: str, dry_run: bool, show_diff: bool,
+         instream: io.TextIOWrapper, outstream: io.TextIOWrapper,
+         script: EditScript = None) -> int:
+    """Edit the file or the stream, returning the exit status
+
+    With dry_run nothing is written and the exit status is EXIT_CHANGED if
+    the editors would change the config. With show_diff a unified diff of
+    the changes is written instead of the edited text. With script the
+    editors are those of the edit script.
+    """
+    patch = Patch() if show_diff else None
+    if file_path:
+        changed = edit_file(file_path, editors, dry_run, patch, script)
+    else:
+        conf = instream.read()
+        if script is not None:
+            text = script.apply(conf, patch)
+        else:
+            text = apply_editors(conf, editors, patch)
+        changed = text != conf
+        if not dry_run and not show_diff:
+            outstream.write(text)
+    if show_diff:
+        outstream.write(patch.format_diff(file_path))
+    return EXIT_CHANGED if dry_run and changed else 0
+
+
+def write_script(editors: list, file_path: str,
+                 instream: io.TextIOWrapper, outstream: io.TextIOWrapper) -> int:
+    """Write the edit script of the editors for the file or the stream"""
+    if file_path:
+        with open(file_path, 'r') as read_file:
+            conf = read_file.read()
+    else:
+        conf = instream.read()
+    print(EditScript.build(conf, editors).dumps(), file=outstream)
+    return 0
+
+
+def option_number(opt: str, optarg: str, number_type: type = int):
+    """Convert the argument of the option to a non-negative number"""
+    try:
+        number = number_type(optarg)
+    except ValueError:
+        number = -1
+    if not number >= 0:
+        raise ExpressionError(f"Invalid Number ({opt} {optarg})")
+    return number
+
+
+def main(argv: list, instream: io.TextIOWrapper = None, outstream: io.TextIOWrapper = None) -> int:
+    """Run htconf with the command line arguments, returning the exit status"""
+    import getopt
+    try:
+        return command(argv, instream, outstream)
+    except (ExpressionError, getopt.GetoptError) as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+
+
+def command(argv: list, instream: io.TextIOWrapper = None, outstream: io.TextIOWrapper = None) -> int:
+    """Run the command of the arguments"""
+    import getopt
+    instream = instream or sys.stdin
+    outstream = outstream or sys.stdout
+    # print usage if no argument or help argument
+    if len(argv) == 1:
+        usage(sys.stderr)
+    elif len(argv) == 2 and argv[1] in ('help', '--help'):
+        usage(outstream)
+    elif argv[1] == 'batch':
+        workers = 0
+        options, _ = getopt.getopt(argv[2:], 'j:', ['jobs='])
+        for opt, optarg in options:
+            if opt in ('-j', '--jobs'):
+                workers = option_number(opt, optarg)
+        batch(instream, outstream, workers)
+    elif argv[1] == 'dump':
+        output_format = 'json'
+        file_paths = []
+        options, _ = getopt.getopt(argv[2:], 'f:', ['format=', 'file='])
+        for opt, optarg in options:
+            if opt == '--format':
+                output_format = optarg
+            elif opt in ('-f', '--file'):
+                file_paths.append(optarg)
+        if not output_format in ('json', 'msgpack'):
+            raise ExpressionError(f"Unknown Format ({output_format})")
+        import importlib.util
+        if output_format == 'msgpack' and importlib.util.find_spec('msgpack') is None:
+            raise ExpressionError("Missing Module (msgpack is required for --format msgpack)")
+        if file_paths:
+            sources = ((file_path, iter_file_lines(file_path)) for file_path in file_paths)
+        else:
+            sources = [(None, map(parse_line, instream))]
+        dump(sources, outstream, output_format)
+    elif argv[1] == 'drift':
+        workers = 0
+        threshold = 0.5
+        options, file_paths = getopt.gnu_getopt(argv[2:], 'j:t:', ['jobs=', 'threshold='])
+        for opt, optarg in options:
+            if opt in ('-j', '--jobs'):
+                workers = option_number(opt, optarg)
+            elif opt in ('-t', '--threshold'):
+                threshold = option_number(opt, optarg, float)
+        import importlib.util
+        if importlib.util.find_spec('numpy') is None:
+            raise ExpressionError("Missing Module (NumPy is required for drift)")
+        if not file_paths:
+            file_paths = [line.rstrip('\n') for line in instream if line.strip()]
+        drift(file_paths, outstream, workers, threshold)
+    elif argv[1] == 'check':
+        workers = 0
+        policy_path = ''
+        options, file_paths = getopt.gnu_getopt(argv[2:], 'p:j:', ['policy=', 'jobs='])
+        for opt, optarg in options:
+            if opt in ('-p', '--policy'):
+                policy_path = optarg
+            elif opt in ('-j', '--jobs'):
+                workers = option_number(opt, optarg)
+        if not policy_path:
+            raise ExpressionError("Missing Policy (-p)")
+        with open(policy_path, 'r') as policy_file:
+            policy = Policy(policy_file.read())
+        return check(policy, file_paths, instream, outstream, workers)
+    elif argv[1] == 'import':
+        file_path = ''
+        input_format = ''
+        dry_run = False
+        show_diff = False
+        options, args = getopt.gnu_getopt(argv[2:], 'f:', ['file=', 'format=', 'dry-run', 'diff'])
+        for opt, optarg in options:
+            if opt in ('-f', '--file'):
+                file_path = optarg
+            elif opt == '--format':
+                input_format = optarg
+            elif opt == '--dry-run':
+                dry_run = True
+            elif opt == '--diff':
+                show_diff = True
+        if len(args) != 1:
+            raise ExpressionError(f"Missing Rows ({' '.join(argv[1:])})")
+        input_format = input_format or ('csv' if args[0].endswith('.csv') else 'json')
+        if not input_format in ('json', 'csv'):
+            raise ExpressionError(f"Unknown Format ({input_format})")
+        with open(args[0], 'r', newline='') as rows_file:
+            importer = Importer(read_rows(rows_file.read(), input_format))
+        return edit(importer.editors, file_path, dry_run, show_diff, instream, outstream, importer)
+    elif argv[1] == 'apply-patch':
+        file_path = ''
+        dry_run = False
+        show_diff = False
+        options, args = getopt.gnu_getopt(argv[2:], 'f:', ['file=', 'dry-run', 'diff'])
+        for opt, optarg in options:
+            if opt in ('-f', '--file'):
+                file_path = optarg
+            elif opt == '--dry-run':
+                dry_run = True
+            elif opt == '--diff':
+                show_diff = True
+        if len(args) != 1:
+            raise ExpressionError(f"Missing Edit Script ({' '.join(argv[1:])})")
+        with open(args[0], 'r') as script_file:
+            script = EditScript.loads(script_file.read())
+        return edit(script.editors, file_path, dry_run, show_diff, instream, outstream, script)
+    elif len(argv) > 2 and '-e' in argv:
+        import shlex
+        expressions = Expressions()
+        file_path = ''
+        dry_run = False
+        show_diff = False
+        make_script = False
+        options, _ = getopt.getopt(argv[1:], 'e:f:',
+                                   ['expression=', 'file=', 'dry-run', 'diff', 'script'])
+        for opt, optarg in options:
+            if opt in ('-e', '--expression'):
+                expressions.add(Editor([argv[0]] + shlex.split(optarg)))
+            elif opt in ('-f', '--file'):
+                file_path = optarg
+            elif opt == '--dry-run':
+                dry_run = True
+            elif opt == '--diff':
+                show_diff = True
+            elif opt == '--script':
+                make_script = True
+        if make_script:
+            return write_script(expressions.editors, file_path, instream, outstream)
+        return edit(expressions.editors, file_path, dry_run, show_diff, instream, outstream)
+
+    elif len(argv) > 2:
+        editor = Editor(argv)
+        if editor.script:
+            return write_script([editor], editor.file_path, instream, outstream)
+        return edit([editor], editor.file_path, editor.dry_run, editor.diff, instream, outstream)
+    return 0
+
+
+##
+# Main
+##
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))